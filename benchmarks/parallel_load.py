@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+
+# Compares the serial and the parallel parsing of the answer files and the
+# time to build the index from scratch, on a synthetic db.
+#
+#   python -m benchmarks.parallel_load [--answers 20000] [--workers 1 2 4 8]
+
+import os
+import sys
+import json
+import time
+import pathlib
+import argparse
+import tempfile
+from typing import Dict, Any, List
+from chatmastermind.index import parse_answer_files, load_index, INDEX_FILE
+from chatmastermind.tags import TAGS_FILE
+from .synthdb import generate
+
+
+def timed(func: Any, *args: Any) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def run(db: pathlib.Path, workers: List[int], repeat: int) -> Dict[str, Any]:
+    names = sorted(file.name for file in db.iterdir() if file.suffix == '.yaml')
+    results: Dict[str, Any] = {'files': len(names), 'cpus': os.cpu_count(), 'parse': {}, 'index': {}}
+    for count in workers:
+        results['parse'][count] = round(min(timed(parse_answer_files, db, names, count) for _ in range(repeat)), 4)
+        index_times = []
+        for _ in range(repeat):
+            for fname in (INDEX_FILE, TAGS_FILE):
+                (db / fname).unlink(missing_ok=True)
+            index_times.append(timed(load_index, db, count))
+        results['index'][count] = round(min(index_times), 4)
+    serial = results['parse'][workers[0]]
+    results['speedup'] = {count: round(serial / seconds, 2) for count, seconds in results['parse'].items()}
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the parallel loading of the answer files")
+    parser.add_argument('-a', '--answers', type=int, default=20000, help='Number of answer files')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='Worker counts to compare')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs per worker count, the fastest one is reported')
+    parser.add_argument('-d', '--db', help='Use this db instead of generating a temporary one')
+    args = parser.parse_args()
+
+    if args.db:
+        results = run(pathlib.Path(args.db), args.workers, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = generate(pathlib.Path(tmpdir) / 'db', answers=args.answers)
+            results = run(db, args.workers, args.repeat)
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+
+# Measures the startup cost of the cmm subcommands with 'python -X importtime'.
+#
+#   python -m benchmarks.startup [--repeat N] [--budget benchmarks/startup_budget.json]
+#
+# Prints one JSON object with the import time, the wall time and the number of
+# imported modules per subcommand. Modules the interpreter imports on its own
+# (site, encodings, ...) are not counted. With --budget the run fails if a subcommand
+# imports for longer than its budget (in milliseconds).
+
+import os
+import re
+import sys
+import json
+import time
+import yaml
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Any, Tuple, Set
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def prepare(tmpdir: Path) -> Dict[str, Tuple[List[str], Dict[str, str]]]:
+    db = tmpdir / 'db'
+    db.mkdir()
+    for num in range(1, 11):
+        with open(db / f'{num:04d}.yaml', 'w') as f:
+            yaml.dump({'question': f'question {num}',
+                       'answer': f'answer {num}',
+                       'tags': ['bench', f'tag{num % 3}']}, f)
+    config = tmpdir / 'config.yaml'
+    with open(config, 'w') as f:
+        yaml.dump({'system': 'system', 'db': str(db),
+                   'openai': {'api_key': 'sk-bench', 'model': 'gpt-4',
+                              'temperature': 0.8, 'max_tokens': 100, 'top_p': 1,
+                              'frequency_penalty': 0, 'presence_penalty': 0}}, f)
+    cmm = [sys.executable, '-X', 'importtime', '-m', 'chatmastermind.main', '-c', str(config)]
+    comp_line = f'cmm -c {config} -t ta'
+    complete_env = {'_ARGCOMPLETE': '1',
+                    '_ARGCOMPLETE_IFS': ' ',
+                    '_ARGCOMPLETE_STDOUT_FILENAME': str(tmpdir / 'completion.out'),
+                    'COMP_LINE': comp_line,
+                    'COMP_POINT': str(len(comp_line))}
+    return {
+        'print': (cmm + ['-p', str(db / '0001.yaml')], {}),
+        'chat': (cmm + ['-d'], {}),
+        'dump': (cmm + ['-D'], {}),
+        'complete': (cmm, complete_env),
+        # the question itself needs the network, only measure what '-q' imports
+        'question': ([sys.executable, '-X', 'importtime', '-c',
+                      'import chatmastermind.main, openai.api_resources.chat_completion'], {}),
+    }
+
+
+def parse_importtime(stderr: str, skip: Set[str]) -> Tuple[float, int, List[Tuple[str, float]]]:
+    total, modules, top = 0, 0, []
+    skipping = False
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        if len(match.group(3)) == 1:
+            skipping = match.group(4) in skip
+        if skipping:
+            continue
+        modules += 1
+        if len(match.group(3)) == 1:
+            # top level imports, their cumulative time covers all nested ones
+            total += int(match.group(2))
+            top.append((match.group(4), int(match.group(2)) / 1000))
+    top.sort(key=lambda item: -item[1])
+    return total / 1000, modules, top
+
+
+def interpreter_imports() -> Set[str]:
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'pass'],
+                          stderr=subprocess.PIPE, text=True, check=True)
+    return {match.group(4) for match in map(IMPORT_LINE.match, proc.stderr.splitlines())
+            if match and len(match.group(3)) == 1}
+
+
+def measure(command: List[str], env: Dict[str, str], repeat: int, skip: Set[str]) -> Dict[str, Any]:
+    best: Dict[str, Any] = {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(command, env={**os.environ, **env},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              text=True)
+        wall = (time.perf_counter() - start) * 1000
+        if proc.returncode != 0:
+            raise RuntimeError(f"'{' '.join(command)}' failed:\n{proc.stderr}")
+        import_ms, modules, top = parse_importtime(proc.stderr, skip)
+        if not best or import_ms < best['import_ms']:
+            best = {'import_ms': round(import_ms, 2),
+                    'wall_ms': round(wall, 2),
+                    'modules': modules,
+                    'top': {name: round(ms, 2) for name, ms in top[:5]}}
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure the import time of the cmm subcommands")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs per subcommand, the fastest one is reported')
+    parser.add_argument('-b', '--budget', help='JSON file with the maximal import time in ms per subcommand')
+    args = parser.parse_args()
+
+    skip = interpreter_imports()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = {name: measure(command, env, args.repeat, skip)
+                   for name, (command, env) in prepare(Path(tmpdir)).items()}
+    print(json.dumps(results, indent=2))
+
+    if args.budget:
+        with open(args.budget) as f:
+            budget = json.load(f)
+        failed = [f"{name}: {results[name]['import_ms']}ms > {limit}ms"
+                  for name, limit in budget.items()
+                  if name in results and results[name]['import_ms'] > limit]
+        if failed:
+            print("Startup budget exceeded:\n" + '\n'.join(failed), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
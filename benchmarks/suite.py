@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+
+# Times the storage and rendering hot paths and the end-to-end 'cmm -q' on a
+# synthetic db, against the local fake OpenAI server from the tests.
+#
+#   python -m benchmarks.suite [--answers N] [--tags N] [--answer-length N]
+#                              [--latency S] [--backend yaml|sqlite]
+#                              [--repeat N] [--output results.json]
+#
+# The results are written as JSON, compare the files of two commits to see
+# the effect of a change.
+
+import io
+import sys
+import json
+import time
+import yaml
+import pathlib
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from contextlib import redirect_stdout
+from typing import Dict, Any, List, Callable
+from unittest import mock
+from chatmastermind import main as cmm
+from chatmastermind.storage import create_chat, get_tags, save_answers
+from chatmastermind.render import display_chat
+from chatmastermind.index import INDEX_FILE
+from chatmastermind.tags import TAGS_FILE
+from chatmastermind.backend import YamlBackend, open_backend, migrate
+from tests.fake_openai import FakeOpenAIServer
+from .synthdb import generate
+
+
+def measure(func: Callable[[], Any], repeat: int, setup: Callable[[], Any] = lambda: None) -> Dict[str, Any]:
+    times: List[float] = []
+    for _ in range(repeat):
+        setup()
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return {'runs': repeat,
+            'min': round(min(times), 6),
+            'median': round(statistics.median(times), 6),
+            'mean': round(statistics.mean(times), 6)}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=pathlib.Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def write_config(tmpdir: pathlib.Path, db: pathlib.Path, api_base: str) -> Dict[str, Any]:
+    config = {'system': 'You are a benchmark.',
+              'db': str(db),
+              'openai': {'api_key': 'sk-bench', 'api_base': api_base, 'model': 'gpt-4',
+                         'temperature': 0.8, 'max_tokens': 500, 'top_p': 1,
+                         'frequency_penalty': 0, 'presence_penalty': 0,
+                         # the whole history is used, so the hot paths scale with the db
+                         'context_window': 10 ** 9}}
+    with open(tmpdir / 'config.yaml', 'w') as f:
+        yaml.dump(config, f)
+    return config
+
+
+def run(args: argparse.Namespace, tmpdir: pathlib.Path) -> Dict[str, Any]:
+    db = generate(tmpdir / 'db', args.answers, args.tags, args.tags_per_answer, args.answer_length)
+    if args.backend == 'sqlite':
+        sqlite_db = tmpdir / 'db.sqlite'
+        migrate(YamlBackend(db), open_backend({'db': str(sqlite_db)}))
+        db = sqlite_db
+    results: Dict[str, Any] = {}
+
+    def drop_index() -> None:
+        # the SQLite backend has no separate index
+        if db.is_dir():
+            for fname in (INDEX_FILE, TAGS_FILE):
+                (db / fname).unlink(missing_ok=True)
+
+    with FakeOpenAIServer(latency=args.latency) as server:
+        config = write_config(tmpdir, db, server.api_base)
+        tag = ['tag0']
+        chat = create_chat('question', tag, None, config)
+        full_chat = create_chat('question', None, None, config)
+
+        results['create_chat_cold_index'] = measure(lambda: create_chat('question', tag, None, config),
+                                                    args.repeat, drop_index)
+        results['create_chat'] = measure(lambda: create_chat('question', tag, None, config), args.repeat)
+        results['create_chat_all'] = measure(lambda: create_chat('question', None, None, config), args.repeat)
+        results['get_tags'] = measure(lambda: get_tags(config, 'tag1'), args.repeat)
+        results['display_chat'] = measure(lambda: display_chat(full_chat), args.repeat)
+        results['display_chat_source_code'] = measure(lambda: display_chat(full_chat, source_code=True), args.repeat)
+        results['display_chat_dump'] = measure(lambda: display_chat(full_chat, dump=True), args.repeat)
+
+        results['save_answers'] = measure(
+            lambda: save_answers('question', ['answer'] * 3, tag, None, config), args.repeat)
+        argv = ['cmm', '-c', str(tmpdir / 'config.yaml'), '-q', 'question', '-t', 'tag0', '-n', '1']
+        with mock.patch.object(sys, 'argv', argv):
+            results['main_question'] = measure(cmm.main, args.repeat)
+
+    return {'commit': git_commit(),
+            'python': platform.python_version(),
+            'parameters': {'backend': args.backend,
+                           'answers': args.answers, 'tags': args.tags,
+                           'tags_per_answer': args.tags_per_answer,
+                           'answer_length': args.answer_length,
+                           'latency': args.latency,
+                           'chat_messages': len(chat),
+                           'all_chat_messages': len(full_chat)},
+            'results': results}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the ChatMastermind hot paths")
+    parser.add_argument('-a', '--answers', type=int, default=2000, help='Number of answers in the synthetic db')
+    parser.add_argument('-t', '--tags', type=int, default=50, help='Number of different tags')
+    parser.add_argument('-p', '--tags-per-answer', type=int, default=2, help='Tags of every answer')
+    parser.add_argument('-l', '--answer-length', type=int, default=1500, help='Length of an answer in characters')
+    parser.add_argument('-L', '--latency', type=float, default=0.0, help='Latency of the fake API in seconds')
+    parser.add_argument('-b', '--backend', choices=['yaml', 'sqlite'], default='yaml', help='Storage backend of the db')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs per benchmark')
+    parser.add_argument('-o', '--output', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = run(args, pathlib.Path(tmpdir))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
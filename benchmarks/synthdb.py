@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+
+# Generates a synthetic db directory in the format written by save_answers.
+#
+#   python -m benchmarks.synthdb DB_DIR [--answers N] [--tags N] [--tags-per-answer N] [--answer-length N]
+
+import sys
+import random
+import pathlib
+import argparse
+from chatmastermind.backend import write_answer
+
+WORDS = ('python', 'yaml', 'answer', 'question', 'function', 'class', 'return', 'value',
+         'list', 'dict', 'string', 'file', 'directory', 'test', 'import', 'module',
+         'error', 'config', 'token', 'model', 'chat', 'history', 'tag', 'storage')
+
+
+def text(rng: random.Random, length: int) -> str:
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    lines = [' '.join(words[pos:pos + 12]) for pos in range(0, len(words), 12)]
+    return '\n'.join(lines)
+
+
+def generate(db: pathlib.Path,
+             answers: int = 1000,
+             tags: int = 50,
+             tags_per_answer: int = 2,
+             answer_length: int = 1500,
+             seed: int = 0
+             ) -> pathlib.Path:
+    rng = random.Random(seed)
+    db.mkdir(parents=True, exist_ok=True)
+    tag_names = [f'tag{num}' for num in range(tags)]
+    for num in range(1, answers + 1):
+        write_answer(db / f'{num:04d}.yaml',
+                     text(rng, answer_length // 5),
+                     text(rng, answer_length),
+                     rng.sample(tag_names, min(tags_per_answer, tags)))
+    with open(db / '.next', 'w') as f:
+        f.write(f'{answers}')
+    return db
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Generate a synthetic ChatMastermind db")
+    parser.add_argument('db', help='Directory to create')
+    parser.add_argument('-a', '--answers', type=int, default=1000, help='Number of answer files')
+    parser.add_argument('-t', '--tags', type=int, default=50, help='Number of different tags')
+    parser.add_argument('-p', '--tags-per-answer', type=int, default=2, help='Tags of every answer')
+    parser.add_argument('-l', '--answer-length', type=int, default=1500, help='Length of an answer in characters')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed of the random generator')
+    args = parser.parse_args()
+    generate(pathlib.Path(args.db), args.answers, args.tags, args.tags_per_answer, args.answer_length, args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,97 @@
-import openai
+from typing import Callable, Mapping, Any
+from .config import SAMPLING_KEYS, sampling_params
+from .tokens import encoding_name, message_tokens, TOKENS_PER_REPLY
+from .scheduler import schedule, rate_limiter
+
+# openai is imported on first use, importing it takes longer than
+# anything else cmm does for the commands that work offline
 
 
 def openai_api_key(api_key: str) -> None:
+    import openai
     openai.api_key = api_key
 
 
+def openai_api_base(api_base: str) -> None:
+    import openai
+    openai.api_base = api_base
+
+
+def openai_session(pool_size: int) -> None:
+    # one session for all threads, so the connections are reused
+    import openai
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    openai.requestssession = session
+
+
+def completion_params(config: Mapping[str, Any], number: int) -> dict:
+    return dict(zip(SAMPLING_KEYS, sampling_params(config)), n=number)
+
+
+def request_tokens(chat: list[dict[str, str]], config: Mapping[str, Any], number: int) -> int:
+    # what the rate limit of the API counts for a request
+    encoding = encoding_name(config['openai']['model'])
+    return sum(message_tokens(message['content'], encoding) for message in chat) \
+        + TOKENS_PER_REPLY + config['openai']['max_tokens'] * number
+
+
 def ai(chat: list[dict[str, str]],
-       config: dict,
+       config: Mapping[str, Any],
        number: int
        ) -> tuple[list[str], dict[str, int]]:
-    response = openai.ChatCompletion.create(
-        model=config['openai']['model'],
+    import openai
+    tokens = request_tokens(chat, config, number)
+    response = schedule(lambda: openai.ChatCompletion.create(
         messages=chat,
-        temperature=config['openai']['temperature'],
-        max_tokens=config['openai']['max_tokens'],
-        top_p=config['openai']['top_p'],
-        n=number,
-        frequency_penalty=config['openai']['frequency_penalty'],
-        presence_penalty=config['openai']['presence_penalty'])
+        **completion_params(config, number)), config, tokens)
     result = []
     for choice in response['choices']:  # type: ignore
         result.append(choice['message']['content'].strip())
-    return result, dict(response['usage'])  # type: ignore
+    usage = dict(response['usage'])  # type: ignore
+    rate_limiter(config).settle(tokens, usage.get('total_tokens', tokens))
+    return result, usage
+
+
+def ai_stream(chat: list[dict[str, str]],
+              config: Mapping[str, Any],
+              number: int,
+              on_delta: Callable[[int, str], None],
+              on_done: Callable[[int, str], None]
+              ) -> tuple[list[str], dict[str, int]]:
+    import openai
+    tokens = request_tokens(chat, config, number)
+    # only opening the stream is retried, the printed deltas can not be taken back
+    response = schedule(lambda: openai.ChatCompletion.create(
+        messages=chat,
+        stream=True,
+        stream_options={'include_usage': True},
+        **completion_params(config, number)), config, tokens)
+    parts: list[list[str]] = [[] for _ in range(number)]
+    finished = [False] * number
+    usage: dict[str, int] = {}
+    deltas = 0
+    for chunk in response:
+        if chunk.get('usage'):  # type: ignore
+            usage = dict(chunk['usage'])  # type: ignore
+        for choice in chunk.get('choices', []):  # type: ignore
+            index = choice['index']
+            content = choice['delta'].get('content')
+            if content:
+                deltas += 1
+                parts[index].append(content)
+                on_delta(index, content)
+            if choice.get('finish_reason') is not None:
+                finished[index] = True
+                on_done(index, ''.join(parts[index]).strip())
+    for index in range(number):
+        if not finished[index]:
+            on_done(index, ''.join(parts[index]).strip())
+    if not usage:
+        # the server did not report the usage, every delta is about one token
+        usage = {'completion_tokens': deltas}
+    rate_limiter(config).settle(tokens, usage.get('total_tokens', tokens))
+    return [''.join(part).strip() for part in parts], usage
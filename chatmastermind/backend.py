@@ -0,0 +1,645 @@
+import io
+import os
+import abc
+import json
+import yaml
+import pathlib
+import threading
+from contextlib import contextmanager
+from .utils import YamlDumper
+from .index import load_index, write_index, select_files, parse_answer_files, group_keys, answer_number
+from .tags import sorted_tags, find_tags, complete_tags
+from .fts import FullTextIndex, FullTextStore, document_text, match_query, top_relevant, fts_path, \
+    open_full_text_store
+from .metrics import phase, count
+from .config import db_path
+from typing import List, Dict, Any, Optional, Union, Tuple, Iterator, cast, Mapping
+
+try:
+    import fcntl
+except ImportError:
+    # without locks, the exclusive creation of the files still prevents
+    # parallel runs from overwriting each other's answers
+    fcntl = None  # type: ignore
+
+# The answers are stored by a backend, either the default directory with one
+# YAML file per answer, or a single SQLite file. Answers are identified by
+# a name ('0001.yaml' or '0001'), names sort in the order of the answers.
+
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3')
+RECORD_KEYS = ('question', 'answer', 'tags')
+CHUNK_SIZE = 500
+
+
+def backend_name(config: Mapping[str, Any]) -> str:
+    if config.get('backend'):
+        return config['backend']
+    return 'sqlite' if str(db_path(config)).endswith(SQLITE_SUFFIXES) else 'yaml'
+
+
+def state_dir(config: Mapping[str, Any]) -> pathlib.Path:
+    # directory for the files kept next to the answers, e.g. the cache
+    db = db_path(config)
+    if backend_name(config) == 'yaml':
+        return db
+    return db.with_name(db.name + '.d')
+
+
+def write_answer(fname: Union[str, pathlib.Path],
+                 question: str,
+                 answer: str,
+                 tags: list[str],
+                 extra: Optional[Dict[str, Any]] = None,
+                 sync: bool = False
+                 ) -> None:
+    with open(fname, "w") as fd:
+        with io.StringIO() as f:
+            yaml.dump({'question': question},
+                      f,
+                      default_style="|",
+                      default_flow_style=False,
+                      Dumper=YamlDumper)
+            fd.write(f.getvalue().replace('"question":', "question:", 1))
+        with io.StringIO() as f:
+            yaml.dump({'answer': answer},
+                      f,
+                      default_style="|",
+                      default_flow_style=False,
+                      Dumper=YamlDumper)
+            fd.write(f.getvalue().replace('"answer":', "answer:", 1))
+        yaml.dump({'tags': tags},
+                  fd,
+                  default_flow_style=False,
+                  Dumper=YamlDumper)
+        if extra:
+            yaml.dump(extra,
+                      fd,
+                      default_flow_style=False,
+                      Dumper=YamlDumper)
+        if sync:
+            fd.flush()
+            os.fsync(fd.fileno())
+
+
+def split_record(record: Dict[str, Any]) -> Tuple[str, str, List[str], Dict[str, Any]]:
+    extra = {key: value for key, value in record.items() if key not in RECORD_KEYS}
+    return record['question'], record['answer'], list(record.get('tags') or []), extra
+
+
+class Backend(abc.ABC):
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abc.abstractmethod
+    def names(self) -> List[str]:
+        ...
+
+    @abc.abstractmethod
+    def number(self, name: str) -> Optional[int]:
+        ...
+
+    @abc.abstractmethod
+    def select(self, tags: Optional[List[str]], extags: Optional[List[str]]) -> List[str]:
+        ...
+
+    @abc.abstractmethod
+    def read(self, names: List[str]) -> List[Dict[str, Any]]:
+        ...
+
+    @abc.abstractmethod
+    def groups(self, names: List[str]) -> List[Tuple[str, bool]]:
+        # (group, selected) of every answer
+        ...
+
+    @abc.abstractmethod
+    def token_counts(self, names: List[str], encoding: str) -> Dict[str, int]:
+        ...
+
+    @abc.abstractmethod
+    def store_token_counts(self, counts: Dict[str, int], encoding: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def tags(self, prefix: Optional[str]) -> List[Tuple[str, int]]:
+        ...
+
+    def search(self, query: str, names: List[str], k: int) -> List[str]:
+        # without a persistent index the candidates are indexed on the fly
+        index = FullTextIndex()
+        for name, data in zip(names, self.read(names)):
+            index.add(name, document_text(data))
+        return top_relevant(names, index.scores(query), k)
+
+    @abc.abstractmethod
+    def reserve(self, count: int) -> int:
+        ...
+
+    @abc.abstractmethod
+    def mark_used(self, num: int) -> None:
+        ...
+
+    def write(self, num: int, record: Dict[str, Any]) -> int:
+        return self.write_many([(num, record)])[0]
+
+    @abc.abstractmethod
+    def write_many(self, records: List[Tuple[int, Dict[str, Any]]]) -> List[int]:
+        # returns the numbers the answers were written with
+        ...
+
+    @abc.abstractmethod
+    def update(self, name: str, record: Dict[str, Any]) -> None:
+        ...
+
+    def refresh(self) -> None:
+        pass
+
+    def complete(self, prefix: Optional[str]) -> List[str]:
+        matches = self.tags(prefix)
+        matches.sort(key=lambda match: -match[1])
+        return [tag for tag, _ in matches]
+
+    def records(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        names = self.names()
+        for pos in range(0, len(names), CHUNK_SIZE):
+            chunk = names[pos:pos + CHUNK_SIZE]
+            yield from zip(chunk, self.read(chunk))
+
+
+class YamlBackend(Backend):
+
+    def __init__(self, db: pathlib.Path, workers: Optional[int] = None, keep_loaded: bool = False) -> None:
+        self.db = db
+        self.workers = workers
+        self._files: Optional[Dict[str, Dict[str, Any]]] = None
+        # name -> (mtime, data) of the answers read before, if kept
+        self._loaded: Optional[Dict[str, Tuple[int, Optional[Dict[str, Any]]]]] = {} if keep_loaded else None
+        self._fts: Optional[FullTextStore] = None
+        # the index the full-text index was last updated for
+        self._fts_files: Optional[Dict[str, Dict[str, Any]]] = None
+        self.fts5 = True
+
+    def files(self) -> Dict[str, Dict[str, Any]]:
+        if self._files is None:
+            self._files = load_index(self.db, self.workers)
+        return self._files
+
+    def __len__(self) -> int:
+        return len(self.files())
+
+    def names(self) -> List[str]:
+        return [name for name, entry in self.files().items() if not entry.get('damaged')]
+
+    def number(self, name: str) -> Optional[int]:
+        return answer_number(name)
+
+    def select(self, tags: Optional[List[str]], extags: Optional[List[str]]) -> List[str]:
+        return select_files(self.files(), tags, extags)
+
+    def read(self, names: List[str]) -> List[Dict[str, Any]]:
+        # damaged answers are never selected, so none of them is None
+        if self._loaded is None:
+            return cast(List[Dict[str, Any]], parse_answer_files(self.db, names, self.workers))
+        files = self.files()
+        loaded = self._loaded
+        outdated = [name for name in names if name not in loaded or loaded[name][0] != files[name]['mtime']]
+        if outdated:
+            for name, data in zip(outdated, parse_answer_files(self.db, outdated, self.workers)):
+                loaded[name] = (files[name]['mtime'], data)
+        return cast(List[Dict[str, Any]], [loaded[name][1] for name in names])
+
+    def groups(self, names: List[str]) -> List[Tuple[str, bool]]:
+        files = self.files()
+        rows = []
+        previous = None
+        for name, entry in files.items():
+            if entry.get('damaged'):
+                continue
+            digest = entry.get('question_digest')
+            rows.append((name, entry.get('group'), digest is not None and digest == previous))
+            previous = digest
+        keys = group_keys(rows)
+        return [(keys[name], files[name].get('selected', False)) for name in names]
+
+    def token_counts(self, names: List[str], encoding: str) -> Dict[str, int]:
+        files = self.files()
+        return {name: files[name]['tokens'][encoding] for name in names
+                if encoding in files[name].get('tokens', {})}
+
+    def store_token_counts(self, counts: Dict[str, int], encoding: str) -> None:
+        # the token counts are cached in the index
+        files = self.files()
+        for name, tokens in counts.items():
+            files[name].setdefault('tokens', {})[encoding] = tokens
+        if counts:
+            write_index(self.db, files)
+
+    def tags(self, prefix: Optional[str]) -> List[Tuple[str, int]]:
+        return find_tags(*sorted_tags(self.files()), prefix)
+
+    def complete(self, prefix: Optional[str]) -> List[str]:
+        # uses the tag store, without scanning the db
+        return complete_tags(self.db, prefix)
+
+    def full_text_index(self) -> Optional[FullTextStore]:
+        # created by the first search, like the index only answers added,
+        # changed or removed since its last update are written
+        if self._fts is None and self.fts5:
+            self._fts = open_full_text_store(self.db)
+            self.fts5 = self._fts is not None
+        if self._fts is None:
+            return None
+        files = self.files()
+        if files is self._fts_files:
+            return self._fts
+        current = {name: entry['mtime'] for name, entry in files.items() if not entry.get('damaged')}
+        indexed = self._fts.mtimes()
+        removed = [name for name in indexed if name not in current]
+        stale = [name for name, mtime in current.items() if indexed.get(name) != mtime]
+        if removed or stale:
+            self._fts.update(removed, [(name, current[name], data) for name, data in zip(stale, self.read(stale))])
+        self._fts_files = files
+        return self._fts
+
+    def search(self, query: str, names: List[str], k: int) -> List[str]:
+        fts = self.full_text_index()
+        if fts is None:
+            return super().search(query, names, k)
+        return top_relevant(names, fts.scores(query, names), k)
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        # serializes the numbering of parallel runs, a separate lock file
+        # since '.next' itself is replaced on every update
+        fd = os.open(self.db / '.next.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def read_next(self) -> int:
+        try:
+            with open(self.db / '.next', 'r') as f:
+                return int(f.read())
+        except Exception:
+            return 0
+
+    def write_next(self, num: int) -> None:
+        tmp_fname = self.db / f'.next.{os.getpid()}.tmp'
+        with open(tmp_fname, 'w') as f:
+            f.write(f'{num}')
+            f.flush()
+            os.fsync(f.fileno())
+        # the directory is synced with the answers
+        os.replace(tmp_fname, self.db / '.next')
+
+    def reserve(self, count: int) -> int:
+        with self.locked():
+            num = self.read_next()
+            self.write_next(num + count)
+        return num + 1
+
+    def mark_used(self, num: int) -> None:
+        with self.locked():
+            if num > self.read_next():
+                self.write_next(num)
+
+    def write_many(self, records: List[Tuple[int, Dict[str, Any]]]) -> List[int]:
+        # every answer is written to a temporary file and then linked to
+        # its name, readers never see a partial file and an existing answer
+        # is never overwritten, e.g. if '.next' was lost
+        nums = []
+        for num, record in records:
+            tmp_fname = self.db / f'.{num:04d}.yaml.{os.getpid()}.tmp'
+            try:
+                write_answer(tmp_fname, *split_record(record), sync=True)
+                while True:
+                    try:
+                        os.link(tmp_fname, self.db / f"{num:04d}.yaml")
+                        break
+                    except FileExistsError:
+                        num = self.reserve(1)
+            finally:
+                tmp_fname.unlink(missing_ok=True)
+            nums.append(num)
+        self.sync()
+        return nums
+
+    def update(self, name: str, record: Dict[str, Any]) -> None:
+        tmp_fname = self.db / f'.{name}.{os.getpid()}.tmp'
+        try:
+            write_answer(tmp_fname, *split_record(record), sync=True)
+            os.replace(tmp_fname, self.db / name)
+        finally:
+            tmp_fname.unlink(missing_ok=True)
+        self.sync()
+
+    def sync(self) -> None:
+        # the files are synced before they are linked or renamed, the
+        # directory once after, so a name never refers to data that was
+        # not written yet, e.g. with the delayed allocation of ext4
+        if not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(self.db, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def refresh(self) -> None:
+        if self.db.is_dir():
+            # keeps the tag store used by the tab completion up to date, a
+            # loaded index is kept in memory and only updated if files changed
+            files = load_index(self.db, self.workers, self._files)
+            if files is self._files:
+                return
+            self._files = files
+            if self._loaded is not None:
+                for name in self._loaded.keys() - self._files.keys():
+                    del self._loaded[name]
+            # the full-text index is created by the first search
+            if fts_path(self.db).exists():
+                self.full_text_index()
+
+
+class SqliteBackend(Backend):
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS answers (
+            num INTEGER PRIMARY KEY,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            tags TEXT NOT NULL,
+            extra TEXT);
+        CREATE TABLE IF NOT EXISTS tags (
+            tag TEXT NOT NULL,
+            num INTEGER NOT NULL,
+            PRIMARY KEY (tag, num)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS tags_num ON tags (num);
+        CREATE TABLE IF NOT EXISTS tokens (
+            num INTEGER NOT NULL,
+            encoding TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            PRIMARY KEY (num, encoding)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL);
+    '''
+    FTS_SCHEMA = '''
+        CREATE VIRTUAL TABLE answers_fts USING fts5 (
+            question, answer, content='answers', content_rowid='num')
+    '''
+
+    def __init__(self, path: pathlib.Path) -> None:
+        import sqlite3
+        self.path = path
+        # autocommit, the transactions are explicit
+        self.conn = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(self.SCHEMA)
+        self.fts5 = self.create_full_text_index()
+
+    def create_full_text_index(self) -> bool:
+        import sqlite3
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'answers_fts'").fetchone():
+            return True
+        try:
+            with self.conn:
+                self.conn.execute('BEGIN')
+                self.conn.execute(self.FTS_SCHEMA)
+                # indexes the answers of a db created without it
+                self.conn.execute("INSERT INTO answers_fts (answers_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError:
+            # SQLite without FTS5, searches fall back to an index in memory
+            return False
+        return True
+
+    def close(self) -> None:
+        self.conn.close()
+
+    @staticmethod
+    def name(num: int) -> str:
+        return f'{num:04d}'
+
+    def chunks(self, names: List[str]) -> Iterator[List[int]]:
+        nums = [int(name) for name in names]
+        for pos in range(0, len(nums), CHUNK_SIZE):
+            yield nums[pos:pos + CHUNK_SIZE]
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+
+    def names(self) -> List[str]:
+        return [self.name(num) for num, in self.conn.execute('SELECT num FROM answers ORDER BY num')]
+
+    def number(self, name: str) -> Optional[int]:
+        return int(name)
+
+    def select(self, tags: Optional[List[str]], extags: Optional[List[str]]) -> List[str]:
+        # both conditions are answered by the (tag, num) primary key
+        query = 'SELECT num FROM answers a WHERE 1'
+        params: List[str] = []
+        if tags:
+            query += f" AND EXISTS (SELECT 1 FROM tags t WHERE t.num = a.num AND t.tag IN ({','.join('?' * len(tags))}))"
+            params += tags
+        if extags:
+            query += f" AND NOT EXISTS (SELECT 1 FROM tags t WHERE t.num = a.num AND t.tag IN ({','.join('?' * len(extags))}))"
+            params += extags
+        with phase('db_scan'):
+            return [self.name(num) for num, in self.conn.execute(query + ' ORDER BY num', params)]
+
+    def read(self, names: List[str]) -> List[Dict[str, Any]]:
+        count('records_read', len(names))
+        result: Dict[int, Dict[str, Any]] = {}
+        with phase('parse'):
+            for nums in self.chunks(names):
+                rows = self.conn.execute('SELECT num, question, answer, tags, extra FROM answers '
+                                         f"WHERE num IN ({','.join('?' * len(nums))})", nums)
+                for num, question, answer, tags, extra in rows:
+                    result[num] = {'question': question, 'answer': answer, 'tags': json.loads(tags),
+                                   **(json.loads(extra) if extra else {})}
+        return [result[int(name)] for name in names]
+
+    def groups(self, names: List[str]) -> List[Tuple[str, bool]]:
+        # an answer without a group continues the group of the answer before
+        # it if that has no group and the same question, compared by SQLite
+        rows = list(self.conn.execute(
+            'SELECT num, grp, selected, grp IS NULL AND LAG(grp IS NULL) OVER w AND question = LAG(question) OVER w '
+            "FROM (SELECT num, question, json_extract(extra, '$.group') AS grp, json_extract(extra, '$.selected') AS selected "
+            'FROM answers) WINDOW w AS (ORDER BY num) ORDER BY num'))
+        keys = group_keys((self.name(num), group, bool(continues)) for num, group, _, continues in rows)
+        selected = {self.name(num) for num, _, is_selected, _ in rows if is_selected}
+        return [(keys[name], name in selected) for name in names]
+
+    def token_counts(self, names: List[str], encoding: str) -> Dict[str, int]:
+        result: Dict[str, int] = {}
+        for nums in self.chunks(names):
+            rows = self.conn.execute('SELECT num, tokens FROM tokens '
+                                     f"WHERE encoding = ? AND num IN ({','.join('?' * len(nums))})", [encoding, *nums])
+            result.update((self.name(num), tokens) for num, tokens in rows)
+        return result
+
+    def store_token_counts(self, counts: Dict[str, int], encoding: str) -> None:
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR REPLACE INTO tokens (num, encoding, tokens) VALUES (?, ?, ?)',
+                                  [(int(name), encoding, tokens) for name, tokens in counts.items()])
+
+    def tags(self, prefix: Optional[str]) -> List[Tuple[str, int]]:
+        # a range scan of the primary key instead of LIKE, which ignores the index
+        prefix = prefix or ''
+        return list(self.conn.execute('SELECT tag, COUNT(*) FROM tags WHERE tag >= ? AND tag < ? GROUP BY tag ORDER BY tag',
+                                      (prefix, prefix + '\U0010ffff')))
+
+    def search(self, query: str, names: List[str], k: int) -> List[str]:
+        if not self.fts5:
+            return super().search(query, names, k)
+        match = match_query(query)
+        if match is None:
+            return []
+        candidates = set(names)
+        scores = {}
+        for num, rank in self.conn.execute('SELECT rowid, bm25(answers_fts) FROM answers_fts WHERE answers_fts MATCH ?',
+                                           (match,)):
+            name = self.name(num)
+            if name in candidates:
+                scores[name] = -rank
+        return top_relevant(names, scores, k)
+
+    def reserve(self, count: int) -> int:
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'next'").fetchone()
+            num = row[0] if row else 0
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next', ?)", (num + count,))
+        return num + 1
+
+    def mark_used(self, num: int) -> None:
+        with self.conn:
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('next', ?) "
+                              'ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)', (num,))
+
+    def write_many(self, records: List[Tuple[int, Dict[str, Any]]]) -> List[int]:
+        with self.conn:
+            self.conn.execute('BEGIN')
+            for num, record in records:
+                question, answer, tags, extra = split_record(record)
+                self.conn.execute('INSERT INTO answers (num, question, answer, tags, extra) VALUES (?, ?, ?, ?, ?)',
+                                  (num, question, answer, json.dumps(tags), json.dumps(extra) if extra else None))
+                self.conn.executemany('INSERT OR IGNORE INTO tags (tag, num) VALUES (?, ?)',
+                                      [(tag, num) for tag in tags])
+                if self.fts5:
+                    self.conn.execute('INSERT INTO answers_fts (rowid, question, answer) VALUES (?, ?, ?)',
+                                      (num, question, answer))
+        return [num for num, _ in records]
+
+    def update(self, name: str, record: Dict[str, Any]) -> None:
+        num = int(name)
+        question, answer, tags, extra = split_record(record)
+        with self.conn:
+            self.conn.execute('BEGIN')
+            if self.fts5:
+                # the external content of the FTS table is removed with its old values
+                self.conn.execute("INSERT INTO answers_fts (answers_fts, rowid, question, answer) "
+                                  "SELECT 'delete', num, question, answer FROM answers WHERE num = ?", (num,))
+            self.conn.execute('UPDATE answers SET question = ?, answer = ?, tags = ?, extra = ? WHERE num = ?',
+                              (question, answer, json.dumps(tags), json.dumps(extra) if extra else None, num))
+            self.conn.execute('DELETE FROM tags WHERE num = ?', (num,))
+            self.conn.executemany('INSERT OR IGNORE INTO tags (tag, num) VALUES (?, ?)', [(tag, num) for tag in tags])
+            self.conn.execute('DELETE FROM tokens WHERE num = ?', (num,))
+            if self.fts5:
+                self.conn.execute('INSERT INTO answers_fts (rowid, question, answer) VALUES (?, ?, ?)',
+                                  (num, question, answer))
+
+
+# Gives the threads of a long running process, e.g. the daemon, one at a
+# time access to a backend that is shared by all of them.
+class SharedBackend:
+
+    def __init__(self, backend: Backend) -> None:
+        self.backend = backend
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.backend)
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args: Any, **kwargs: Any) -> Any:
+            with self.lock:
+                return attr(*args, **kwargs)
+        return locked
+
+
+# the backends are kept open and their answers in memory after keep_backends()
+_resident: Optional[Dict[Tuple[str, str], Backend]] = None
+_resident_lock = threading.Lock()
+
+
+def keep_backends() -> None:
+    global _resident
+    _resident = {}
+
+
+def resident_backends() -> List[Backend]:
+    with _resident_lock:
+        return list(_resident.values()) if _resident is not None else []
+
+
+def create_backend(config: Mapping[str, Any], keep_loaded: bool = False) -> Backend:
+    db = db_path(config)
+    name = backend_name(config)
+    if name == 'yaml':
+        return YamlBackend(db, config.get('workers'), keep_loaded)
+    if name == 'sqlite':
+        return SqliteBackend(db)
+    raise ValueError(f"unknown storage backend '{name}'")
+
+
+def open_backend(config: Mapping[str, Any]) -> Backend:
+    if _resident is None:
+        return create_backend(config)
+    key = (backend_name(config), str(db_path(config).resolve()))
+    with _resident_lock:
+        if key not in _resident:
+            _resident[key] = SharedBackend(create_backend(config, keep_loaded=True))  # type: ignore
+        return _resident[key]
+
+
+def migrate(source: Backend, target: Backend) -> int:
+    # copies all answers, their numbers are kept where possible
+    if len(target):
+        raise ValueError('the target db is not empty')
+    copied = 0
+    pending: List[Tuple[int, Dict[str, Any]]] = []
+    unnumbered: List[Dict[str, Any]] = []
+    for name, record in source.records():
+        num = source.number(name)
+        if num is None:
+            unnumbered.append(record)
+            continue
+        pending.append((num, record))
+        if len(pending) >= CHUNK_SIZE:
+            copied += flush_records(target, pending)
+    copied += flush_records(target, pending)
+    if unnumbered:
+        num = target.reserve(len(unnumbered))
+        copied += flush_records(target, list(enumerate(unnumbered, start=num)))
+    target.refresh()
+    return copied
+
+
+def flush_records(target: Backend, pending: List[Tuple[int, Dict[str, Any]]]) -> int:
+    copied = len(pending)
+    if pending:
+        target.write_many(pending)
+        target.mark_used(max(num for num, _ in pending))
+        pending.clear()
+    return copied
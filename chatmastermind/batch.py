@@ -0,0 +1,101 @@
+import sys
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Mapping
+from .utils import terminal_width, YamlLoader
+from .backend import open_backend
+from .storage import select_history, load_history, build_chat, save_answers
+from .api_client import openai_session
+from .cache import cached_ai
+from .sources import compose_sources
+from .metrics import phase, count_usage
+
+DEFAULT_CONCURRENCY = 4
+BATCH_KEYS = {'question', 'source', 'tags', 'extags', 'output_tags', 'number'}
+
+
+def as_list(value: Any) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(item) for item in value]
+    return [str(value)]
+
+
+def read_batch(fname: str) -> List[Dict[str, Any]]:
+    if fname == '-':
+        data = yaml.load(sys.stdin, Loader=YamlLoader)
+    else:
+        with open(fname, 'r') as f:
+            data = yaml.load(f, Loader=YamlLoader)
+    if not isinstance(data, list):
+        raise ValueError(f"{fname}: the batch file must contain a list of questions")
+    items = []
+    for num, entry in enumerate(data, start=1):
+        if isinstance(entry, str):
+            entry = {'question': entry}
+        if not isinstance(entry, dict) or not (entry.keys() & {'question', 'source'}):
+            raise ValueError(f"{fname}: entry {num} has neither a question nor a source")
+        unknown = entry.keys() - BATCH_KEYS
+        if unknown:
+            raise ValueError(f"{fname}: entry {num} has unknown keys: {', '.join(sorted(unknown))}")
+        items.append({'question': as_list(entry.get('question')),
+                      'source': as_list(entry.get('source')),
+                      'tags': as_list(entry.get('tags')),
+                      'extags': as_list(entry.get('extags')),
+                      'output_tags': as_list(entry.get('output_tags')),
+                      'number': entry.get('number')})
+    return items
+
+
+def prepare_chats(items: List[Dict[str, Any]],
+                  questions: List[str],
+                  extras: List[Dict[str, Any]],
+                  config: Mapping[str, Any]
+                  ) -> List[List[Dict[str, str]]]:
+    # the history is read once for all questions
+    backend = open_backend(config)
+    loaded: Dict[str, Dict[str, Any]] = {}
+    histories = [select_history(question, item['tags'], item['extags'], config, backend, loaded)
+                 for item, question in zip(items, questions)]
+    load_history(backend, sorted(set().union(*histories)), loaded)
+    return [build_chat(question, config, (loaded[name] for name in names), extra.get('sources'))
+            for question, extra, names in zip(questions, extras, histories)]
+
+
+def run_batch(items: List[Dict[str, Any]],
+              config: Mapping[str, Any],
+              number: int,
+              concurrency: Optional[int] = None,
+              use_cache: bool = True
+              ) -> int:
+    composed = [compose_sources(item['question'], item['source']) for item in items]
+    questions = [question for question, _, _ in composed]
+    extras = [extra for _, extra, _ in composed]
+    chats = prepare_chats(items, questions, extras, config)
+    concurrency = concurrency or config.get('concurrency') or DEFAULT_CONCURRENCY
+    openai_session(concurrency)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(cached_ai, chat, config, item['number'] or number, use_cache)
+                   for item, chat in zip(items, chats)]
+        # the results are saved in the order of the batch file
+        for num, (item, (question, extra, blobs), future) in enumerate(zip(items, composed, futures), start=1):
+            title = f'== QUESTION {num}/{len(items)} '
+            print(f"{title}{'=' * (terminal_width() - len(title))}")
+            print(question)
+            try:
+                with phase('api'):
+                    answers, usage, cached = future.result()
+            except Exception as e:
+                print(f"Error: {e}")
+                failed += 1
+                continue
+            if not cached:
+                count_usage(usage)
+            save_answers(question, answers, item['tags'], item['output_tags'], config, update_index=False,
+                         extra=extra, blobs=blobs)
+            print("-" * terminal_width())
+            print(f"Usage: {usage}{' (cached)' if cached else ''}")
+    open_backend(config).refresh()
+    return 1 if failed else 0
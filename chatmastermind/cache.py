@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import hashlib
+import pathlib
+from typing import List, Dict, Any, Optional, Tuple, Mapping
+from .utils import write_json
+from .api_client import ai, completion_params
+from .backend import state_dir
+
+DEFAULT_MAX_SIZE = 100  # MB
+DEFAULT_MAX_AGE = 30  # days
+
+
+def cache_config(config: Mapping[str, Any]) -> Optional[Mapping[str, Any]]:
+    # the cache is opt-in, 'cache: true' enables it with the defaults
+    cache = config.get('cache')
+    if not cache:
+        return None
+    return cache if isinstance(cache, Mapping) else {}
+
+
+def cache_dir(config: Mapping[str, Any], cache: Mapping[str, Any]) -> pathlib.Path:
+    return pathlib.Path(cache.get('dir') or state_dir(config) / '.cache')
+
+
+def cache_key(chat: List[Dict[str, str]], config: Mapping[str, Any], number: int) -> str:
+    data = {'messages': chat, **completion_params(config, number)}
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def cache_lookup(chat: List[Dict[str, str]],
+                 config: Mapping[str, Any],
+                 number: int
+                 ) -> Optional[Tuple[List[str], Dict[str, int]]]:
+    cache = cache_config(config)
+    if cache is None:
+        return None
+    fname = cache_dir(config, cache) / f'{cache_key(chat, config, number)}.json'
+    try:
+        if time.time() - fname.stat().st_mtime > cache.get('max_age', DEFAULT_MAX_AGE) * 86400:
+            return None
+        with open(fname, 'r') as f:
+            data = json.load(f)
+        # the modification time is the time of the last use
+        os.utime(fname)
+    except (OSError, ValueError):
+        return None
+    return data['answers'], data['usage']
+
+
+def cache_store(chat: List[Dict[str, str]],
+                config: Mapping[str, Any],
+                number: int,
+                answers: List[str],
+                usage: Dict[str, int]
+                ) -> None:
+    cache = cache_config(config)
+    if cache is None:
+        return
+    directory = cache_dir(config, cache)
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return
+    write_json(directory / f'{cache_key(chat, config, number)}.json', {'answers': answers, 'usage': usage})
+    evict(directory,
+          cache.get('max_size', DEFAULT_MAX_SIZE) * 1024 * 1024,
+          cache.get('max_age', DEFAULT_MAX_AGE) * 86400)
+
+
+def evict(directory: pathlib.Path, max_size: float, max_age: float) -> None:
+    # removes the entries not used for max_age seconds, then the least
+    # recently used ones until the cache is not larger than max_size
+    now = time.time()
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort(reverse=True)
+    size = 0
+    for mtime, entry_size, path in entries:
+        size += entry_size
+        if now - mtime > max_age or size > max_size:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def cached_ai(chat: List[Dict[str, str]],
+              config: Mapping[str, Any],
+              number: int,
+              use_cache: bool = True
+              ) -> Tuple[List[str], Dict[str, int], bool]:
+    # the answers, their usage and whether they came from the cache, the
+    # usage of cached answers is not counted again
+    cached = cache_lookup(chat, config, number) if use_cache else None
+    if cached is not None:
+        return *cached, True
+    answers, usage = ai(chat, config, number)
+    if use_cache:
+        cache_store(chat, config, number, answers, usage)
+    return answers, usage, False
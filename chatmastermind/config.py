@@ -0,0 +1,108 @@
+import os
+import pathlib
+import threading
+from types import MappingProxyType
+from collections import ChainMap
+from dataclasses import dataclass
+from functools import cached_property
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Mapping
+from .utils import YamlSafeLoader
+
+# The config is an immutable mapping. A config file is read once and kept
+# by its path and modification time, the overrides of the command line are
+# layers on top of it, e.g. '-M' replaces config['openai']['model'] without
+# a copy of the config.
+
+SAMPLING_KEYS = ('model', 'temperature', 'max_tokens', 'top_p', 'frequency_penalty', 'presence_penalty')
+
+_configs: Dict[str, Tuple[Tuple[int, int], 'Config']] = {}
+_configs_lock = threading.Lock()
+
+
+def freeze(value: Any) -> Any:
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def merge(values: List[Any]) -> Any:
+    # the values of one key in all layers, the top one first, mappings are
+    # merged key by key (read-only, the ChainMap is only used through a
+    # MappingProxyType)
+    maps: List[Any] = []
+    for value in values:
+        if not isinstance(value, Mapping):
+            break
+        maps.append(value)
+    if len(maps) > 1:
+        return MappingProxyType(ChainMap(*maps))
+    return values[0]
+
+
+@dataclass(frozen=True, eq=False)
+class Config(Mapping[str, Any]):
+    # frozen mappings, the top one first
+    layers: Tuple[Mapping[str, Any], ...]
+    path: Optional[str] = None
+
+    def __post_init__(self) -> None:
+        keys = dict.fromkeys(key for layer in reversed(self.layers) for key in layer)
+        data = {key: merge([layer[key] for layer in self.layers if key in layer]) for key in keys}
+        object.__setattr__(self, '_data', data)
+
+    def __getitem__(self, key: str) -> Any:
+        return self._data[key]  # type: ignore
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._data)  # type: ignore
+
+    def __len__(self) -> int:
+        return len(self._data)  # type: ignore
+
+    def override(self, overrides: Mapping[str, Any]) -> 'Config':
+        return Config((freeze(overrides), *self.layers), self.path)
+
+    @cached_property
+    def db_path(self) -> pathlib.Path:
+        return pathlib.Path(self['db'])
+
+    @cached_property
+    def sampling_params(self) -> Tuple[Any, ...]:
+        return tuple(self['openai'][key] for key in SAMPLING_KEYS)
+
+
+def with_overrides(config: Mapping[str, Any], overrides: Mapping[str, Any]) -> Config:
+    if isinstance(config, Config):
+        return config.override(overrides)
+    return Config((freeze(overrides), freeze(config)))
+
+
+def db_path(config: Mapping[str, Any]) -> pathlib.Path:
+    return config.db_path if isinstance(config, Config) else pathlib.Path(config['db'])
+
+
+def sampling_params(config: Mapping[str, Any]) -> Tuple[Any, ...]:
+    if isinstance(config, Config):
+        return config.sampling_params
+    return tuple(config['openai'][key] for key in SAMPLING_KEYS)
+
+
+def load_config(fname: str) -> Config:
+    import yaml
+    path = os.path.abspath(fname)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _configs_lock:
+        cached = _configs.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    with open(path, 'r') as f:
+        data = yaml.load(f, Loader=YamlSafeLoader)
+    if not isinstance(data, Mapping):
+        raise ValueError(f"{fname}: the config has to be a mapping")
+    config = Config((freeze(data),), path)
+    with _configs_lock:
+        _configs[path] = (version, config)
+    return config
@@ -0,0 +1,359 @@
+import io
+import os
+import sys
+import json
+import pathlib
+import argparse
+import threading
+from typing import List, Dict, Any, Optional, Iterator, Mapping
+
+# 'cmm --daemon' keeps the config, the history of the db and the HTTP
+# connections in memory and serves '-q', '-d', '-D' and the tab completion
+# over a Unix socket. The cmm commands are thin clients while it runs.
+#
+# The client sends one JSON line with the request, the daemon answers with
+# JSON lines: {"out": text}, {"err": text}, {"result": value} and finally
+# {"exit": code}. Without a daemon, the client only looks for a socket
+# before it runs the command itself.
+
+WATCH_INTERVAL = 1.0  # seconds
+FRAME_SIZE = 65536
+POOL_SIZE = 8
+
+
+def socket_dir() -> pathlib.Path:
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return pathlib.Path(runtime_dir)
+    # Unix sockets only, so no need for the platform logic of tempfile
+    return pathlib.Path(os.environ.get('TMPDIR') or '/tmp') / f'cmm-{os.getuid()}'
+
+
+def socket_path(config_file: str) -> pathlib.Path:
+    # one daemon per config file, the path has to stay below ~100 characters
+    import hashlib
+    digest = hashlib.sha256(os.path.abspath(config_file).encode('utf-8')).hexdigest()[:16]
+    return socket_dir() / f'cmm-{digest}.sock'
+
+
+def is_private(directory: pathlib.Path) -> bool:
+    # nobody else may run a daemon the questions are sent to
+    try:
+        stat = directory.stat()
+    except OSError:
+        return False
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+
+def daemon_running() -> bool:
+    try:
+        return any(name.startswith('cmm-') and name.endswith('.sock') for name in os.listdir(socket_dir()))
+    except OSError:
+        return False
+
+
+def connect(config_file: str) -> Optional[Any]:
+    if not daemon_running():
+        return None
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    path = socket_path(config_file)
+    if not is_private(path.parent):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        # no daemon or a stale socket of a daemon that was killed
+        sock.close()
+        return None
+    return sock
+
+
+def frames(sock: Any, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    with sock, sock.makefile('rb') as f:
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        for line in f:
+            yield json.loads(line)
+
+
+def client_args(args: argparse.Namespace) -> Dict[str, Any]:
+    # the daemon runs in another directory, the paths are made absolute
+    result = dict(vars(args))
+    if result.get('source'):
+        result['source'] = [os.path.abspath(fname) for fname in result['source']]
+    if result.get('metrics_json'):
+        result['metrics_json'] = os.path.abspath(result['metrics_json'])
+    result['config'] = os.path.abspath(result['config'])
+    return result
+
+
+def run_remote(args: argparse.Namespace) -> Optional[int]:
+    sock = connect(args.config)
+    if sock is None:
+        return None
+    from .utils import terminal_width
+    request = {'args': client_args(args), 'cwd': os.getcwd(), 'width': terminal_width()}
+    try:
+        for frame in frames(sock, request):
+            if 'out' in frame:
+                sys.stdout.write(frame['out'])
+                sys.stdout.flush()
+            elif 'err' in frame:
+                sys.stdout.flush()
+                sys.stderr.write(frame['err'])
+            elif 'exit' in frame:
+                return frame['exit']
+    except (OSError, ValueError):
+        pass
+    print("Error: lost the connection to the daemon", file=sys.stderr)
+    return 1
+
+
+def complete_remote(config_file: str, prefix: Optional[str]) -> Optional[List[str]]:
+    sock = connect(config_file)
+    if sock is None:
+        return None
+    try:
+        for frame in frames(sock, {'complete': prefix, 'cwd': os.getcwd()}):
+            if 'result' in frame:
+                return frame['result']
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+_local = threading.local()
+
+
+# Sends the output of one request to its client, in frames of up to
+# FRAME_SIZE characters. Output to stderr is sent at once, after the
+# output to stdout written before it.
+class Connection:
+
+    def __init__(self, wfile: Any) -> None:
+        self.wfile = wfile
+        self.pending: List[List[str]] = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, key: str, text: str) -> None:
+        if self.pending and self.pending[-1][0] == key:
+            self.pending[-1][1] += text
+        else:
+            self.pending.append([key, text])
+        self.size += len(text)
+        if key == 'err' or self.size >= FRAME_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        pending, self.pending, self.size = self.pending, [], 0
+        for key, text in pending:
+            self.send({key: text})
+
+    def send(self, frame: Dict[str, Any]) -> None:
+        # a client that went away, e.g. with Ctrl-C, does not stop the
+        # request, its answers are still saved
+        if self.closed:
+            return
+        try:
+            self.wfile.write(json.dumps(frame).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        except OSError:
+            self.closed = True
+
+
+class ClientStream(io.TextIOBase):
+
+    def __init__(self, connection: Connection, key: str) -> None:
+        self.connection = connection
+        self.key = key
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        self.connection.write(self.key, text)
+        return len(text)
+
+    def flush(self) -> None:
+        self.connection.flush()
+
+
+# Replaces sys.stdout and sys.stderr of the daemon, every request thread
+# writes to its own client.
+class ThreadOutput(io.TextIOBase):
+
+    def __init__(self, name: str, default: Any) -> None:
+        self.name = name
+        self.default = default
+
+    def target(self) -> Any:
+        return getattr(_local, self.name, None) or self.default
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        return self.target().write(text)
+
+    def flush(self) -> None:
+        self.target().flush()
+
+
+def absolute_paths(config: Mapping[str, Any], cwd: str) -> Mapping[str, Any]:
+    # paths in the config are relative to the directory of the client
+    from .config import with_overrides
+    overrides: Dict[str, Any] = {'db': os.path.join(cwd, config['db'])}
+    if config.get('metrics_json'):
+        overrides['metrics_json'] = os.path.join(cwd, config['metrics_json'])
+    for section in ('cache', 'summary'):
+        if isinstance(config.get(section), Mapping) and config[section].get('dir'):
+            overrides[section] = {'dir': os.path.join(cwd, config[section]['dir'])}
+    return with_overrides(config, overrides)
+
+
+class Daemon:
+
+    def __init__(self, config_file: str) -> None:
+        from .main import create_parser
+        self.config_file = os.path.abspath(config_file)
+        self.config: Optional[Mapping[str, Any]] = None
+        self.lock = threading.Lock()
+        self.parser = create_parser()
+
+    def request_config(self, cwd: str) -> Mapping[str, Any]:
+        from .main import read_config, setup_api
+        # the config is read again when it was changed, it is immutable and
+        # shared by all requests
+        config = read_config(self.config_file)
+        with self.lock:
+            if config is not self.config:
+                self.config = config
+                setup_api(config)
+        return absolute_paths(config, cwd)
+
+    def handle(self, request: Dict[str, Any], connection: Connection) -> int:
+        from .main import apply_overrides, run_command, report_metrics
+        from .backend import open_backend
+        from .utils import set_terminal_width
+        config = self.request_config(request['cwd'])
+        if 'complete' in request:
+            connection.send({'result': open_backend(config).complete(request['complete'])})
+            return 0
+        args = argparse.Namespace(**request['args'])
+        set_terminal_width(request.get('width'))
+        config = apply_overrides(args, config)
+        result = run_command(args, config, self.parser)
+        report_metrics(args, config)
+        return result
+
+    def preload(self, cwd: str) -> None:
+        from .backend import open_backend
+        backend = open_backend(self.request_config(cwd))
+        backend.read(backend.names())
+
+    def watch(self, cwd: str) -> None:
+        # new and changed answers are read in the background, e.g. those
+        # saved by cmm commands that did not use the daemon
+        import time
+        from .backend import resident_backends
+        try:
+            self.preload(cwd)
+        except Exception as e:
+            print(f"Warning: reading the db failed: {e}", file=sys.__stderr__)
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            for backend in resident_backends():
+                try:
+                    backend.refresh()
+                except Exception as e:
+                    print(f"Warning: reading the db failed: {e}", file=sys.__stderr__)
+
+
+def handle_connection(daemon: Daemon, rfile: Any, wfile: Any) -> None:
+    from . import metrics
+    try:
+        request = json.loads(rfile.readline())
+    except ValueError:
+        return
+    connection = Connection(wfile)
+    _local.stdout = ClientStream(connection, 'out')
+    _local.stderr = ClientStream(connection, 'err')
+    try:
+        # the metrics of this request only, with reading the config
+        with metrics.recording():
+            code = daemon.handle(request, connection)
+    except SystemExit as e:
+        # e.g. parser.error()
+        code = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        code = 1
+    finally:
+        _local.__dict__.clear()
+    connection.flush()
+    connection.send({'exit': code})
+
+
+def prepare_socket(path: pathlib.Path) -> None:
+    import socket
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if not is_private(path.parent):
+        raise RuntimeError(f"{path.parent} is accessible by other users")
+    if path.exists():
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(path))
+        except OSError:
+            path.unlink()
+        else:
+            raise RuntimeError(f"a daemon is already running on {path}")
+        finally:
+            probe.close()
+
+
+def serve(config_file: str) -> int:
+    import signal
+    import socket
+    import socketserver
+    from .backend import keep_backends
+    from .api_client import openai_session
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            handle_connection(daemon, self.rfile, self.wfile)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if not hasattr(socket, 'AF_UNIX'):
+        print("Error: the daemon needs Unix sockets", file=sys.stderr)
+        return 1
+    path = socket_path(config_file)
+    try:
+        prepare_socket(path)
+        daemon = Daemon(config_file)
+        daemon.request_config(os.getcwd())
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    keep_backends()
+    openai_session(POOL_SIZE)
+    threading.Thread(target=daemon.watch, args=(os.getcwd(),), daemon=True).start()
+    server = Server(str(path), Handler)
+    # SystemExit stops serve_forever() and the socket is removed
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    stdout, stderr = sys.stdout, sys.stderr
+    print(f"Serving {daemon.config_file} on {path}", flush=True)
+    sys.stdout, sys.stderr = ThreadOutput('stdout', stdout), ThreadOutput('stderr', stderr)  # type: ignore
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        server.server_close()
+        path.unlink(missing_ok=True)
+    return 0
@@ -0,0 +1,75 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Optional, Tuple, Mapping
+from .utils import terminal_width
+from .storage import save_answers, new_group
+from .backend import open_backend
+from .api_client import openai_session
+from .cache import cached_ai
+from .metrics import phase, count_usage
+from .config import with_overrides
+from .tokens import context_window
+
+# One chat sent to several models at once. The answers of every model are
+# printed and saved as soon as it is done, all of them in one answer group.
+
+
+def model_config(config: Mapping[str, Any], model: str) -> Mapping[str, Any]:
+    return with_overrides(config, {'openai': {'model': model}})
+
+
+def history_config(config: Mapping[str, Any], models: List[str]) -> Mapping[str, Any]:
+    # the same chat is sent to every model, its history has to fit into the
+    # smallest context window, max_tokens is the same for all of them
+    openai_config = config.get('openai', {})
+    windows = [window for window in (context_window(model, openai_config) for model in models) if window is not None]
+    if not windows:
+        return config
+    return with_overrides(config, {'openai': {'context_window': min(windows)}})
+
+
+def ask_model(chat: List[Dict[str, str]],
+              config: Mapping[str, Any],
+              number: int,
+              use_cache: bool
+              ) -> Tuple[List[str], Dict[str, int], bool, float]:
+    start = time.perf_counter()
+    answers, usage, cached = cached_ai(chat, config, number, use_cache)
+    return answers, usage, cached, time.perf_counter() - start
+
+
+def ask_models(chat: List[Dict[str, str]],
+               question: str,
+               tags: List[str],
+               otags: Optional[List[str]],
+               config: Mapping[str, Any],
+               models: List[Tuple[str, int]],
+               use_cache: bool = True,
+               extra: Optional[Dict[str, Any]] = None,
+               blobs: Optional[Dict[str, str]] = None
+               ) -> int:
+    openai_session(len(models))
+    failed = 0
+    group = new_group()
+    with ThreadPoolExecutor(max_workers=len(models)) as executor:
+        futures = {executor.submit(ask_model, chat, model_config(config, model), number, use_cache): model
+                   for model, number in models}
+        with phase('api'):
+            for future in as_completed(futures):
+                model = futures[future]
+                title = f'== MODEL {model} '
+                print(f"{title}{'=' * (terminal_width() - len(title))}")
+                try:
+                    answers, usage, cached, latency = future.result()
+                except Exception as e:
+                    print(f"Error: {e}")
+                    failed += 1
+                    continue
+                if not cached:
+                    count_usage(usage)
+                record = {**(extra or {}), 'model': model, 'latency': round(latency, 3), 'usage': usage, 'group': group}
+                save_answers(question, answers, tags, otags, config, update_index=False, extra=record, blobs=blobs)
+                print("-" * terminal_width())
+                print(f"Usage: {usage}{' (cached)' if cached else ''}, latency: {latency:.2f}s")
+    open_backend(config).refresh()
+    return 1 if failed else 0
@@ -0,0 +1,133 @@
+import re
+import math
+import pathlib
+from typing import List, Dict, Any, Optional, Tuple
+
+# BM25 ranked full-text indexes over the questions and answers, used to pick
+# the history that is most relevant for a new question. The YAML backend
+# keeps an FTS5 index in a SQLite file next to the answers, FullTextIndex
+# is the index in memory used without FTS5.
+
+FTS_FILE = '.fts.sqlite'
+K1 = 1.2
+B = 0.75
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def document_text(data: Dict[str, Any]) -> str:
+    return f"{data.get('question', '')}\n{data.get('answer', '')}"
+
+
+def match_query(query: str) -> Optional[str]:
+    # any of the terms, bm25() ranks the matches (lower is better)
+    terms = set(tokenize(query))
+    if not terms:
+        return None
+    return ' OR '.join(f'"{term}"' for term in terms)
+
+
+class FullTextIndex:
+
+    def __init__(self) -> None:
+        # docs: name -> number of terms, postings: term -> {name: term frequency}
+        self.docs: Dict[str, int] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+
+    def add(self, name: str, text: str) -> None:
+        terms = tokenize(text)
+        self.docs[name] = len(terms)
+        freqs: Dict[str, int] = {}
+        for term in terms:
+            freqs[term] = freqs.get(term, 0) + 1
+        for term, freq in freqs.items():
+            self.postings.setdefault(term, {})[name] = freq
+
+    def scores(self, query: str) -> Dict[str, float]:
+        if not self.docs:
+            return {}
+        total = len(self.docs)
+        avg_length = sum(self.docs.values()) / total or 1
+        result: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for name, freq in postings.items():
+                norm = K1 * (1 - B + B * self.docs[name] / avg_length)
+                result[name] = result.get(name, 0.0) + idf * freq * (K1 + 1) / (freq + norm)
+        return result
+
+
+def top_relevant(names: List[str], scores: Dict[str, float], k: int) -> List[str]:
+    # the k best answers, in their original order
+    ranked = sorted((name for name in names if scores.get(name, 0) > 0), key=lambda name: -scores[name])
+    best = set(ranked[:k])
+    return [name for name in names if name in best]
+
+
+def fts_path(db: pathlib.Path) -> pathlib.Path:
+    return db / FTS_FILE
+
+
+# The FTS5 index of the answers of a YAML db. A search reads only the
+# postings of its terms, a saved answer only adds its own in a transaction.
+class FullTextStore:
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS docs (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            mtime INTEGER NOT NULL);
+        CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5 (question, answer);
+    '''
+
+    def __init__(self, path: pathlib.Path) -> None:
+        import sqlite3
+        # autocommit, the transactions are explicit
+        self.conn = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # fails with sqlite3.OperationalError without FTS5
+        self.conn.executescript(self.SCHEMA)
+
+    def mtimes(self) -> Dict[str, int]:
+        return dict(self.conn.execute('SELECT name, mtime FROM docs'))
+
+    def update(self, removed: List[str], added: List[Tuple[str, int, Dict[str, Any]]]) -> None:
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            for name in [*removed, *(name for name, _, _ in added)]:
+                self.conn.execute('DELETE FROM docs_fts WHERE rowid IN (SELECT id FROM docs WHERE name = ?)', (name,))
+                self.conn.execute('DELETE FROM docs WHERE name = ?', (name,))
+            for name, mtime, data in added:
+                doc_id = self.conn.execute('INSERT INTO docs (name, mtime) VALUES (?, ?)', (name, mtime)).lastrowid
+                self.conn.execute('INSERT INTO docs_fts (rowid, question, answer) VALUES (?, ?, ?)',
+                                  (doc_id, str(data.get('question', '')), str(data.get('answer', ''))))
+
+    def scores(self, query: str, names: List[str]) -> Dict[str, float]:
+        match = match_query(query)
+        if match is None:
+            return {}
+        candidates = set(names)
+        result = {}
+        for name, rank in self.conn.execute('SELECT d.name, bm25(docs_fts) FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid '
+                                            'WHERE docs_fts MATCH ?', (match,)):
+            if name in candidates:
+                result[name] = -rank
+        return result
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def open_full_text_store(db: pathlib.Path) -> Optional[FullTextStore]:
+    import sqlite3
+    try:
+        return FullTextStore(fts_path(db))
+    except sqlite3.OperationalError:
+        return None
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import pathlib
+import yaml
+from .utils import write_json, YamlLoader
+from .tags import write_tag_store
+from .metrics import phase, count
+from typing import List, Dict, Any, Optional, Tuple, Iterable, TypeGuard
+
+
+INDEX_FILE = '.index.json'
+INDEX_VERSION = 3
+PARALLEL_MIN_FILES = 500
+
+
+def index_path(db: pathlib.Path) -> pathlib.Path:
+    return db / INDEX_FILE
+
+
+def read_index(db: pathlib.Path) -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(index_path(db), 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+        return {}
+    return data.get('files', {})
+
+
+def write_index(db: pathlib.Path, files: Dict[str, Dict[str, Any]]) -> None:
+    write_json(index_path(db), {'version': INDEX_VERSION, 'files': files})
+    write_tag_store(db, files)
+
+
+def answer_number(name: str) -> Optional[int]:
+    stem = name.split('.')[0]
+    return int(stem) if stem.isdigit() else None
+
+
+def name_order(name: str) -> Tuple[bool, int, str]:
+    # by number, '10000.yaml' after '9999.yaml', files without a number last
+    num = answer_number(name)
+    return num is None, num or 0, name
+
+
+def is_answer(data: Any) -> TypeGuard[Dict[str, Any]]:
+    return isinstance(data, dict) and 'question' in data and 'answer' in data
+
+
+def question_digest(data: Dict[str, Any]) -> str:
+    import hashlib
+    return hashlib.sha256(str(data.get('question', '')).encode('utf-8')).hexdigest()[:16]
+
+
+def group_keys(rows: Iterable[Tuple[str, Any, bool]]) -> Dict[str, str]:
+    # rows: (name, group, continues) of the answers in their order. Answers
+    # saved before the groups were recorded have no group, consecutive ones
+    # to the same question were saved together (continues is true for all
+    # but the first one) and form a group.
+    keys = {}
+    run = ''
+    for name, group, continues in rows:
+        if group is not None:
+            keys[name] = str(group)
+            continue
+        if not continues:
+            run = f'answers:{name}'
+        keys[name] = run
+    return keys
+
+
+def index_entry(data: Optional[Dict[str, Any]], stat: os.stat_result) -> Dict[str, Any]:
+    if not is_answer(data):
+        # e.g. truncated by a crash, it is skipped until it is fixed
+        return {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'tags': [], 'damaged': True}
+    entry = {'mtime': stat.st_mtime_ns,
+             'size': stat.st_size,
+             'tags': list(data.get('tags') or []),
+             'question': len(str(data.get('question', '')).encode('utf-8')),
+             'answer': len(str(data.get('answer', '')).encode('utf-8'))}
+    if data.get('group') is not None:
+        entry['group'] = data['group']
+    else:
+        entry['question_digest'] = question_digest(data)
+    if data.get('selected'):
+        entry['selected'] = True
+    return entry
+
+
+def parse_answer_file(file: pathlib.Path) -> Optional[Dict[str, Any]]:
+    with open(file, 'r') as f:
+        try:
+            return yaml.load(f, Loader=YamlLoader)
+        except yaml.YAMLError:
+            return None
+
+
+def parse_answer_files(db: pathlib.Path,
+                       names: List[str],
+                       workers: Optional[int] = None
+                       ) -> List[Optional[Dict[str, Any]]]:
+    # a pool only pays off for many files, its startup costs ~100 ms
+    if workers is None:
+        workers = os.cpu_count() or 1
+    count('files_parsed', len(names))
+    with phase('parse'):
+        if workers <= 1 or len(names) < PARALLEL_MIN_FILES:
+            return [parse_answer_file(db / name) for name in names]
+        from concurrent.futures import ProcessPoolExecutor
+        chunksize = max(1, min(256, len(names) // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(parse_answer_file, [db / name for name in names], chunksize=chunksize))
+
+
+def scan_db(db: pathlib.Path) -> Dict[str, os.stat_result]:
+    result = {}
+    with os.scandir(db) as it:
+        for entry in it:
+            if entry.name.endswith('.yaml') and entry.is_file():
+                result[entry.name] = entry.stat()
+    return result
+
+
+def load_index(db: pathlib.Path,
+               workers: Optional[int] = None,
+               files: Optional[Dict[str, Dict[str, Any]]] = None
+               ) -> Dict[str, Dict[str, Any]]:
+    with phase('db_scan'):
+        return update_index(db, workers, files)
+
+
+def update_index(db: pathlib.Path,
+                 workers: Optional[int] = None,
+                 files: Optional[Dict[str, Dict[str, Any]]] = None
+                 ) -> Dict[str, Dict[str, Any]]:
+    # only files added or changed since the last run are parsed again,
+    # 'files' is an index kept in memory, it is returned as it is if no
+    # file changed
+    known = files is not None
+    if files is None:
+        files = read_index(db)
+    stats = scan_db(db)
+    changed = len(files) != len(stats) or not files.keys() <= stats.keys()
+    result: Dict[str, Dict[str, Any]] = {}
+    outdated = []
+    for name in sorted(stats, key=name_order):
+        stat = stats[name]
+        entry = files.get(name)
+        if entry is None or entry.get('mtime') != stat.st_mtime_ns or entry.get('size') != stat.st_size:
+            outdated.append(name)
+        # outdated entries keep their place, they are replaced below
+        result[name] = entry or {}
+    for name, data in zip(outdated, parse_answer_files(db, outdated, workers)):
+        result[name] = index_entry(data, stats[name])
+        if result[name].get('damaged'):
+            print(f"Warning: skipping damaged answer file {db / name}", file=sys.stderr)
+        changed = True
+    if not changed:
+        return files if known else result
+    write_index(db, result)
+    return result
+
+
+def select_files(files: Dict[str, Dict[str, Any]],
+                 tags: Optional[List[str]],
+                 extags: Optional[List[str]]
+                 ) -> List[str]:
+    result = []
+    for name, entry in files.items():
+        if entry.get('damaged'):
+            continue
+        data_tags = set(entry['tags'])
+        tags_match = \
+            not tags or data_tags.intersection(tags)
+        extags_do_not_match = \
+            not extags or not data_tags.intersection(extags)
+        if tags_match and extags_do_not_match:
+            result.append(name)
+    return result
@@ -2,25 +2,33 @@
 # -*- coding: utf-8 -*-
 # vim: set fileencoding=utf-8 :
 
+import os
 import yaml
 import sys
-import argcomplete
+import pathlib
 import argparse
-from .utils import terminal_width, pp, process_tags, display_chat
-from .storage import save_answers, create_chat, get_tags
-from .api_client import ai, openai_api_key
+from typing import Iterable, Optional, Mapping, Any, cast
+from .utils import terminal_width, pp, process_tags, YamlLoader
+from .storage import save_answers, create_chat, iter_chat, select_answer, AnswerStream
+from .render import display_chat
+from .sources import compose_sources, copy_blobs
+from .config import Config, load_config, with_overrides
+from .backend import open_backend, backend_name, migrate
+from .api_client import ai, ai_stream, openai_api_key, openai_api_base
+from .scheduler import throttle_stats
+from .metrics import phase, count_usage, record, print_summary, append_jsonl
 
 
-def run_print_command(args: argparse.Namespace, config: dict) -> None:
+def run_print_command(args: argparse.Namespace, config: Mapping[str, Any]) -> None:
     with open(args.print, 'r') as f:
-        data = yaml.load(f, Loader=yaml.FullLoader)
+        data = yaml.load(f, Loader=YamlLoader)
     pp(data)
 
 
 def process_and_display_chat(args: argparse.Namespace,
-                             config: dict,
+                             config: Mapping[str, Any],
                              dump: bool = False
-                             ) -> tuple[list[dict[str, str]], str, list[str]]:
+                             ) -> tuple[Iterable[dict[str, str]], str, list[str], dict, dict[str, str]]:
     tags = args.tags or []
     extags = args.extags or []
     otags = args.output_tags or []
@@ -28,45 +36,133 @@ def process_and_display_chat(args: argparse.Namespace,
     if not args.only_source_code:
         process_tags(tags, extags, otags)
 
-    question_parts = []
-    question_list = args.question if args.question is not None else []
-    source_list = args.source if args.source is not None else []
+    question, extra, blobs = compose_sources(args.question or [], args.source or [])
 
-    for question, source in zip(question_list, source_list):
-        with open(source) as r:
-            question_parts.append(f"{question}\n\n```\n{r.read().strip()}\n```")
+    chat_config = config
+    if args.models and question:
+        from .fanout import history_config
+        chat_config = history_config(config, [model for model, _ in args.models])
+    stats: dict[str, int] = {}
+    # without a question the chat is only displayed, the history is read
+    # while it is rendered
+    chat = (create_chat if question else iter_chat)(question, tags, extags, chat_config, stats=stats,
+                                                    sources=extra.get('sources'))
+    if stats.get('dropped_messages') and not args.only_source_code:
+        print(f"Dropped {stats['dropped_messages']} messages ({stats['dropped_tokens']} tokens) "
+              "of the chat history to fit into the context window")
+        print()
+    if stats.get('summarized_messages') and not args.only_source_code:
+        print(f"Summarized {stats['summarized_messages']} older messages of the chat history")
+        print()
+    with phase('render'):
+        display_chat(chat, dump, args.only_source_code)
+    return chat, question, tags, extra, blobs
 
-    if len(question_list) > len(source_list):
-        for question in question_list[len(source_list):]:
-            question_parts.append(question)
-    else:
-        for source in source_list[len(question_list):]:
-            with open(source) as r:
-                question_parts.append(f"```\n{r.read().strip()}\n```")
-
-    question = '\n\n'.join(question_parts)
 
-    chat = create_chat(question, tags, extags, config)
-    display_chat(chat, dump, args.only_source_code)
-    return chat, question, tags
+def print_throttling(config: Mapping[str, Any], before: dict[str, Any]) -> None:
+    # only the throttling of this invocation
+    stats = throttle_stats(config, before)
+    if stats['throttled'] or stats['retries']:
+        print(f"Throttled: {stats['throttled']:.1f}s, retries: {stats['retries']}")
 
 
 def handle_question(args: argparse.Namespace,
-                    config: dict,
+                    config: Mapping[str, Any],
                     dump: bool = False
-                    ) -> None:
-    chat, question, tags = process_and_display_chat(args, config, dump)
+                    ) -> int:
+    from .cache import cache_lookup, cache_store
+    throttled = throttle_stats(config)
+    chat, question, tags, extra, blobs = process_and_display_chat(args, config, dump)
+    # with a question the whole chat was built at once
+    messages = cast(list[dict[str, str]], chat)
     otags = args.output_tags or []
-    answers, usage = ai(chat, config, args.number)
-    save_answers(question, answers, tags, otags, config)
+    if args.models:
+        from .fanout import ask_models
+        models = [(model, number or args.number) for model, number in args.models]
+        result = ask_models(messages, question, tags, otags, config, models, not args.no_cache, extra, blobs)
+        print_throttling(config, throttled)
+        return result
+    cached = None if args.no_cache else cache_lookup(messages, config, args.number)
+    if cached is not None:
+        answers, usage = cached
+        save_answers(question, answers, tags, otags, config, extra=extra, blobs=blobs)
+    elif args.stream:
+        stream = AnswerStream(question, tags, otags, config, args.number, extra, blobs)
+        with phase('api'):
+            answers, usage = ai_stream(messages, config, args.number, stream.delta, stream.done)
+    else:
+        with phase('api'):
+            answers, usage = ai(messages, config, args.number)
+        save_answers(question, answers, tags, otags, config, extra=extra, blobs=blobs)
+    if cached is None:
+        count_usage(usage)
+        if not args.no_cache:
+            cache_store(messages, config, args.number, answers, usage)
     print("-" * terminal_width())
-    print(f"Usage: {usage}")
+    print(f"Usage: {usage}{' (cached)' if cached is not None else ''}")
+    print_throttling(config, throttled)
+    return 0
+
+
+def handle_batch(args: argparse.Namespace,
+                 config: Mapping[str, Any],
+                 parser: argparse.ArgumentParser
+                 ) -> int:
+    from .batch import read_batch, run_batch
+    try:
+        items = read_batch(args.batch)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        parser.error(str(e))
+    throttled = throttle_stats(config)
+    result = run_batch(items, config, args.number, args.concurrency, not args.no_cache)
+    print_throttling(config, throttled)
+    return result
+
+
+def handle_migrate(args: argparse.Namespace,
+                   config: Mapping[str, Any],
+                   parser: argparse.ArgumentParser
+                   ) -> None:
+    import sqlite3
+    target_config = {'db': args.migrate}
+    if backend_name(target_config) == 'yaml':
+        pathlib.Path(args.migrate).mkdir(parents=True, exist_ok=True)
+    try:
+        copied = migrate(open_backend(config), open_backend(target_config))
+        copy_blobs(config, target_config)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        parser.error(f"{args.migrate}: {e}")
+    print(f"Copied {copied} answers to {args.migrate}")
+
+
+def handle_select(args: argparse.Namespace,
+                  config: Mapping[str, Any],
+                  parser: argparse.ArgumentParser
+                  ) -> None:
+    try:
+        answers = select_answer(config, args.select)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Selected answer {args.select} of {answers} answers to its question")
 
 
 def tags_completer(prefix, parsed_args, **kwargs):
-    with open(parsed_args.config, 'r') as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
-    return get_tags(config, prefix)
+    from .daemon import complete_remote
+    tags = complete_remote(parsed_args.config, prefix)
+    if tags is not None:
+        return tags
+    return open_backend(load_config(parsed_args.config)).complete(prefix)
+
+
+def model_list(value: str) -> list[tuple[str, Optional[int]]]:
+    # 'gpt-4,gpt-3.5-turbo:2', the number of answers defaults to -n
+    models = []
+    for entry in value.split(','):
+        model, _, number = entry.strip().partition(':')
+        if not model or (number and not number.isdigit()):
+            raise argparse.ArgumentTypeError(f"invalid model '{entry}', use MODEL or MODEL:NUMBER")
+        models.append((model, int(number) if number else None))
+    return models
 
 
 def create_parser() -> argparse.ArgumentParser:
@@ -78,51 +174,144 @@ def create_parser() -> argparse.ArgumentParser:
     group.add_argument('-q', '--question', nargs='*', help='Question to ask')
     group.add_argument('-D', '--chat-dump', help="Print chat as Python structure", action='store_true')
     group.add_argument('-d', '--chat', help="Print chat as readable text", action='store_true')
+    group.add_argument('-b', '--batch', help="YAML file with a list of questions to ask, '-' reads it from stdin")
+    group.add_argument('--migrate', metavar='DEST',
+                       help="Copy all answers to a new db, a '.sqlite' file or a directory of YAML files")
+    group.add_argument('--select', metavar='NUM', type=int,
+                       help='Use answer NUM in the chat history instead of the other answers to its question')
+    group.add_argument('--daemon', help='Serve the commands of this config from memory, other cmm commands use it when it runs',
+                       action='store_true')
     parser.add_argument('-c', '--config', help='Config file name.', default=default_config)
     parser.add_argument('-m', '--max-tokens', help='Max tokens to use', type=int)
     parser.add_argument('-T', '--temperature', help='Temperature to use', type=float)
     parser.add_argument('-M', '--model', help='Model to use')
+    parser.add_argument('--models', type=model_list,
+                        help='Ask several models at once, a list like MODEL1,MODEL2:NUMBER')
     parser.add_argument('-n', '--number', help='Number of answers to produce', type=int, default=3)
+    parser.add_argument('--relevant', metavar='K', type=int,
+                        help='Use only the K answers of the history most relevant for the question')
+    parser.add_argument('--concurrency', help='Number of questions of a batch asked at the same time', type=int)
+    parser.add_argument('--no-cache', help='Do not use the response cache', action='store_true')
+    parser.add_argument('--stream', help='Print the answers while they are generated', action='store_true')
+    parser.add_argument('--no-daemon', help='Do not use a running daemon', action='store_true')
+    parser.add_argument('--profile', help='Print the time spent in every phase of the command', action='store_true')
+    parser.add_argument('--metrics-json', help='Append the timings and counters of the command as JSON line to this file')
     parser.add_argument('-s', '--source', nargs='*', help='Source add content of a file to the query')
     parser.add_argument('-S', '--only-source-code', help='Print only source code', action='store_true')
+    parser.add_argument('--pager', help='Show the output of -d and -D in $PAGER', action='store_true')
     tags_arg = parser.add_argument('-t', '--tags', nargs='*', help='List of tag names', metavar='TAGS')
     tags_arg.completer = tags_completer  # type: ignore
     extags_arg = parser.add_argument('-e', '--extags', nargs='*', help='List of tag names to exclude', metavar='EXTAGS')
     extags_arg.completer = tags_completer  # type: ignore
     otags_arg = parser.add_argument('-o', '--output-tags', nargs='*', help='List of output tag names, default is input', metavar='OTAGS')
     otags_arg.completer = tags_completer  # type: ignore
-    argcomplete.autocomplete(parser)
+    if '_ARGCOMPLETE' in os.environ:
+        import argcomplete
+        argcomplete.autocomplete(parser)
     return parser
 
 
-def main() -> int:
-    parser = create_parser()
-    args = parser.parse_args()
+def run_command(args: argparse.Namespace,
+                config: Mapping[str, Any],
+                parser: argparse.ArgumentParser
+                ) -> int:
+    if args.print:
+        run_print_command(args, config)
+    elif args.question:
+        if args.models and args.stream:
+            parser.error('--stream cannot be used with --models')
+        return handle_question(args, config)
+    elif args.batch:
+        return handle_batch(args, config, parser)
+    elif args.chat_dump:
+        process_and_display_chat(args, config, dump=True)
+    elif args.chat:
+        process_and_display_chat(args, config)
+    elif args.migrate:
+        handle_migrate(args, config, parser)
+    elif args.select is not None:
+        handle_select(args, config, parser)
+    return 0
 
-    with open(args.config, 'r') as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
 
-    openai_api_key(config['openai']['api_key'])
+def command_name(args: argparse.Namespace) -> str:
+    for name in ('print', 'question', 'batch', 'chat_dump', 'chat', 'migrate', 'daemon'):
+        if getattr(args, name):
+            return name
+    return 'select' if args.select is not None else 'unknown'
+
+
+def report_metrics(args: argparse.Namespace, config: Mapping[str, Any]) -> None:
+    metrics_file = args.metrics_json or config.get('metrics_json')
+    if not args.profile and not metrics_file:
+        return
+    data = record(command_name(args))
+    if args.profile:
+        print_summary(data)
+    if metrics_file:
+        append_jsonl(metrics_file, data)
 
+
+def read_config(fname: str) -> Config:
+    with phase('config'):
+        return load_config(fname)
+
+
+def apply_overrides(args: argparse.Namespace, config: Mapping[str, Any]) -> Mapping[str, Any]:
+    openai_overrides: dict[str, Any] = {}
     if args.max_tokens:
-        config['openai']['max_tokens'] = args.max_tokens
+        openai_overrides['max_tokens'] = args.max_tokens
 
     if args.temperature:
-        config['openai']['temperature'] = args.temperature
+        openai_overrides['temperature'] = args.temperature
 
     if args.model:
-        config['openai']['model'] = args.model
+        openai_overrides['model'] = args.model
 
-    if args.print:
-        run_print_command(args, config)
-    elif args.question:
-        handle_question(args, config)
-    elif args.chat_dump:
-        process_and_display_chat(args, config, dump=True)
-    elif args.chat:
-        process_and_display_chat(args, config)
+    overrides: dict[str, Any] = {'openai': openai_overrides} if openai_overrides else {}
+    if args.relevant:
+        overrides['relevant'] = args.relevant
+    return with_overrides(config, overrides) if overrides else config
 
-    return 0
+
+def setup_api(config: Mapping[str, Any]) -> None:
+    openai_api_key(config['openai']['api_key'])
+    if config['openai'].get('api_base'):
+        openai_api_base(config['openai']['api_base'])
+
+
+def run(args: argparse.Namespace, parser: argparse.ArgumentParser) -> int:
+    if (args.question or args.chat or args.chat_dump) and not args.no_daemon:
+        # a running daemon answers without the startup costs
+        from .daemon import run_remote
+        result = run_remote(args)
+        if result is not None:
+            return result
+
+    config = apply_overrides(args, read_config(args.config))
+
+    if args.question or args.batch:
+        setup_api(config)
+
+    result = run_command(args, config, parser)
+    report_metrics(args, config)
+    return result
+
+
+def main() -> int:
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.daemon:
+        from .daemon import serve
+        return serve(args.config)
+
+    if args.pager and (args.chat or args.chat_dump):
+        # also the output of the daemon goes through the pager of the client
+        from .render import paged
+        with paged():
+            return run(args, parser)
+    return run(args, parser)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,110 @@
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, Optional, TextIO
+
+# Per invocation timings and counters. A phase is timed without the phases
+# nested in it, e.g. 'parse' inside of 'db_scan' is only counted as 'parse'.
+# Phases running in several threads at once are summed up.
+
+
+class Recorder:
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.phases: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+        self.started = time.perf_counter()
+
+
+_local = threading.local()
+_process = Recorder()
+
+
+def current() -> Recorder:
+    # the recorder of the request run by this thread, e.g. in the daemon,
+    # otherwise the one of the process
+    return getattr(_local, 'recorder', None) or _process
+
+
+def reset() -> None:
+    global _process
+    _process = Recorder()
+
+
+@contextmanager
+def recording() -> Iterator[None]:
+    # records the phases and counters of this thread apart from those of
+    # requests running in parallel
+    _local.recorder = Recorder()
+    try:
+        yield
+    finally:
+        del _local.recorder
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    stack = _local.__dict__.setdefault('stack', [])
+    # [time of the nested phases]
+    frame = [0.0]
+    stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        if stack:
+            stack[-1][0] += elapsed
+        recorder = current()
+        with recorder.lock:
+            recorder.phases[name] = recorder.phases.get(name, 0.0) + elapsed - frame[0]
+
+
+def count(name: str, value: int = 1) -> None:
+    recorder = current()
+    with recorder.lock:
+        recorder.counters[name] = recorder.counters.get(name, 0) + value
+
+
+def count_usage(usage: Dict[str, int]) -> None:
+    for name in ('prompt_tokens', 'completion_tokens'):
+        if name in usage:
+            count(name, usage[name])
+
+
+def record(command: Optional[str] = None) -> Dict[str, Any]:
+    recorder = current()
+    with recorder.lock:
+        phases = {name: round(seconds, 6) for name, seconds in recorder.phases.items()}
+        counters = dict(recorder.counters)
+        total = time.perf_counter() - recorder.started
+    result: Dict[str, Any] = {'timestamp': time.time(),
+                              'command': command,
+                              'total': round(total, 6),
+                              'phases': phases,
+                              'counters': counters}
+    if counters.get('completion_tokens') and phases.get('api'):
+        result['tokens_per_second'] = round(counters['completion_tokens'] / phases['api'], 2)
+    return result
+
+
+def print_summary(data: Dict[str, Any], out: Optional[TextIO] = None) -> None:
+    # sys.stderr when it is printed, the daemon replaces it
+    out = out or sys.stderr
+    print(f"Total: {data['total'] * 1000:.1f} ms", file=out)
+    for name, seconds in sorted(data['phases'].items(), key=lambda item: -item[1]):
+        print(f"  {name:<12} {seconds * 1000:10.1f} ms", file=out)
+    for name, value in sorted(data['counters'].items()):
+        print(f"  {name:<20} {value:>8}", file=out)
+    if 'tokens_per_second' in data:
+        print(f"  {'tokens_per_second':<20} {data['tokens_per_second']:>8}", file=out)
+
+
+def append_jsonl(fname: str, data: Dict[str, Any]) -> None:
+    # one short write per record, records of parallel runs do not mix
+    with open(fname, 'a') as f:
+        f.write(json.dumps(data) + '\n')
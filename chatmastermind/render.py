@@ -0,0 +1,118 @@
+import os
+import sys
+from contextlib import contextmanager
+from typing import List, Dict, Iterable, Iterator, Optional, TextIO
+from .utils import terminal_width
+
+# The chat is rendered message by message into chunks of text, which are
+# written in blocks of BUFFER_SIZE characters. A chat read lazily from the
+# db is never completely in memory.
+
+BUFFER_SIZE = 65536
+
+
+def code_blocks(content: str) -> Iterator[str]:
+    # the lines between code fences, in one pass over the message
+    inside = False
+    for line in content.splitlines():
+        if line.lstrip().startswith('```'):
+            inside = not inside
+        elif inside:
+            yield line
+
+
+def render_chat(chat: Iterable[Dict[str, str]], width: int, source_code: bool = False) -> Iterator[str]:
+    for message in chat:
+        role, content = message['role'], message['content']
+        if source_code:
+            for line in code_blocks(content):
+                yield f'{line}\n'
+            continue
+        if role == 'user':
+            yield '-' * width + '\n'
+        if len(content) > width - len(role) - 2:
+            yield f"{role.upper()}:\n{content}\n"
+        else:
+            yield f"{role.upper()}: {content}\n"
+
+
+def render_dump(chat: Iterable[Dict[str, str]], width: int) -> Iterator[str]:
+    # the layout of pprint for the list of messages, but every message is
+    # formatted on its own instead of the whole list at once
+    from pprint import PrettyPrinter
+    messages = iter(chat)
+    # a chat that fits into one line is printed in one line
+    head: List[Dict[str, str]] = []
+    size = 0
+    for message in messages:
+        head.append(message)
+        size += len(repr(message)) + 2
+        if size > width:
+            break
+    else:
+        yield PrettyPrinter(width=width).pformat(head) + '\n'
+        return
+    # pprint formats every item of a list that does not fit into one line
+    # like the only item of a list, with room for the bracket or comma
+    printer = PrettyPrinter(width=width)
+    prefix = '['
+    for message in (*head, *messages):
+        yield prefix + printer.pformat([message])[1:-1]
+        prefix = ',\n '
+    yield ']\n'
+
+
+def write_buffered(chunks: Iterable[str], out: TextIO) -> None:
+    buffer: List[str] = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= BUFFER_SIZE:
+            out.write(''.join(buffer))
+            buffer.clear()
+            size = 0
+    out.write(''.join(buffer))
+    out.flush()
+
+
+def display_chat(chat: Iterable[Dict[str, str]],
+                 dump: bool = False,
+                 source_code: bool = False,
+                 out: Optional[TextIO] = None
+                 ) -> None:
+    width = terminal_width()
+    chunks = render_dump(chat, width) if dump else render_chat(chat, width, source_code)
+    write_buffered(chunks, out or sys.stdout)
+
+
+@contextmanager
+def paged() -> Iterator[None]:
+    # sends stdout through $PAGER, 'less' by default, if it is a terminal
+    import shlex
+    import subprocess
+    if not sys.stdout.isatty():
+        yield
+        return
+    env = dict(os.environ)
+    env.setdefault('LESS', 'FRX')
+    try:
+        pager = subprocess.Popen(shlex.split(os.environ.get('PAGER') or 'less'),
+                                 stdin=subprocess.PIPE, text=True, env=env)
+    except OSError:
+        yield
+        return
+    stdout = sys.stdout
+    sys.stdout = pager.stdin  # type: ignore
+    try:
+        yield
+    except BrokenPipeError:
+        # the pager was closed before everything was written
+        pass
+    finally:
+        sys.stdout = stdout
+        try:
+            pager.stdin.close()  # type: ignore
+        except BrokenPipeError:
+            pass
+        pager.wait()
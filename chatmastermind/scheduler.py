@@ -0,0 +1,154 @@
+import time
+import random
+import threading
+from typing import Dict, Any, Optional, Callable, TypeVar, Tuple, Mapping
+
+# Every API request passes through a rate limiter with a requests per minute
+# and a tokens per minute bucket, and is retried with a jittered exponential
+# backoff on rate limits and transient server errors.
+
+T = TypeVar('T')
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 1.0  # seconds
+MAX_BACKOFF = 60.0  # seconds
+
+
+class TokenBucket:
+
+    def __init__(self, per_minute: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.clock = clock
+        self.updated = clock()
+
+    def refill(self) -> None:
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # a request larger than the bucket only waits for a full bucket
+        self.refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: float) -> None:
+        # the level can get negative, e.g. if a request used more tokens
+        # than estimated, later requests have to wait for it
+        self.refill()
+        self.level -= amount
+
+
+class RateLimiter:
+
+    def __init__(self,
+                 rpm: Optional[float] = None,
+                 tpm: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep
+                 ) -> None:
+        self.requests = TokenBucket(rpm, clock) if rpm else None
+        self.tokens = TokenBucket(tpm, clock) if tpm else None
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.throttled = 0.0
+        self.retries = 0
+
+    def acquire(self, tokens: int) -> None:
+        while True:
+            with self.lock:
+                wait = max(self.requests.wait_time(1) if self.requests else 0.0,
+                           self.tokens.wait_time(tokens) if self.tokens else 0.0)
+                if wait <= 0:
+                    if self.requests:
+                        self.requests.consume(1)
+                    if self.tokens:
+                        self.tokens.consume(tokens)
+                    return
+                self.throttled += wait
+            self.sleep(wait)
+
+    def settle(self, estimated: int, used: int) -> None:
+        if self.tokens:
+            with self.lock:
+                self.tokens.consume(used - estimated)
+
+    def backoff(self, delay: float) -> None:
+        with self.lock:
+            self.throttled += delay
+            self.retries += 1
+        self.sleep(delay)
+
+
+_limiters: Dict[Tuple[Optional[float], Optional[float]], RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def rate_limiter(config: Mapping[str, Any]) -> RateLimiter:
+    # one limiter per limits, shared by all threads of the process
+    openai_config = config.get('openai', {})
+    key = (openai_config.get('rpm'), openai_config.get('tpm'))
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(*key)
+        return _limiters[key]
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(error, 'headers', None) or {}
+    headers = {str(name).lower(): value for name, value in headers.items()}
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    import openai.error
+    if isinstance(error, (openai.error.RateLimitError,
+                          openai.error.ServiceUnavailableError,
+                          openai.error.APIConnectionError,
+                          openai.error.Timeout,
+                          openai.error.TryAgain)):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+def backoff_delay(attempt: int, base: float) -> float:
+    # "full jitter", spreads the retries of concurrent requests
+    return random.uniform(0, min(MAX_BACKOFF, base * 2 ** attempt))
+
+
+def schedule(request: Callable[[], T], config: Mapping[str, Any], tokens: int) -> T:
+    limiter = rate_limiter(config)
+    max_retries = config['openai'].get('max_retries', DEFAULT_MAX_RETRIES)
+    base = config['openai'].get('backoff', DEFAULT_BACKOFF)
+    attempt = 0
+    while True:
+        limiter.acquire(tokens)
+        try:
+            return request()
+        except Exception as e:
+            # a failed request did not use any tokens
+            limiter.settle(tokens, 0)
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = retry_after(e)
+            limiter.backoff(backoff_delay(attempt, base) if delay is None else delay)
+            attempt += 1
+
+
+def throttle_stats(config: Mapping[str, Any], before: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # before: the stats at the start of an invocation, the limiter is shared
+    # by all invocations of a daemon
+    limiter = rate_limiter(config)
+    before = before or {'throttled': 0.0, 'retries': 0}
+    return {'throttled': round(limiter.throttled - before['throttled'], 3), 'retries': limiter.retries - before['retries']}
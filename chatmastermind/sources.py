@@ -0,0 +1,180 @@
+import os
+import pathlib
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple, Callable, Set, Mapping
+from .utils import compose_question, read_source
+from .backend import state_dir
+
+# The files attached with '-s' are stored once in a content-addressed blob
+# store. The stored question refers to them by a line '@blob:<sha256>' in
+# place of their content, and the 'sources' of an answer list the file
+# and blob of every reference. The blobs are only read when the history
+# is sent or shown.
+
+BLOB_DIR = '.blobs'
+MMAP_MIN_SIZE = 1024 * 1024
+BLOB_REF = '@blob:'
+# how the sources of the history are sent: 'all' of them, every content
+# only once ('dedup') or only the 'latest' version of every file
+SOURCE_MODES = ('all', 'dedup', 'latest')
+DEFAULT_SOURCE_MODE = 'dedup'
+
+
+def blob_dir(config: Mapping[str, Any]) -> pathlib.Path:
+    return state_dir(config) / BLOB_DIR
+
+
+def blob_digest(text: str) -> str:
+    import hashlib
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def store_blob(config: Mapping[str, Any], text: str) -> str:
+    data = text.encode('utf-8')
+    digest = blob_digest(text)
+    directory = blob_dir(config)
+    fname = directory / digest
+    if fname.exists():
+        return digest
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp_fname = directory / f'.{digest}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_fname, 'wb') as f:
+            f.write(data)
+        # the same content under the same name, parallel runs do not conflict
+        os.replace(tmp_fname, fname)
+    finally:
+        tmp_fname.unlink(missing_ok=True)
+    return digest
+
+
+def read_blob(config: Mapping[str, Any], digest: str) -> Optional[str]:
+    try:
+        with open(blob_dir(config) / digest, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < MMAP_MIN_SIZE:
+                return f.read().decode('utf-8')
+            # decoded straight from the page cache, without a copy of the bytes
+            import mmap
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return str(data, 'utf-8')
+    except OSError:
+        return None
+
+
+def compose_sources(question_list: List[str],
+                    source_list: List[str]
+                    ) -> Tuple[str, Dict[str, Any], Dict[str, str]]:
+    # the question to send, the keys of the answers to save, with the
+    # question referring to the sources, and the blobs of the sources
+    # (digest -> content), which are only stored with the answers
+    contents = {fname: read_source(fname) for fname in source_list}
+    question = compose_question(question_list, source_list, read=contents.__getitem__)
+    if not source_list:
+        return question, {}, {}
+    digests = {fname: blob_digest(content) for fname, content in contents.items()}
+    stored = compose_question(question_list, source_list, read=lambda fname: BLOB_REF + digests[fname])
+    return (question,
+            {'question': stored,
+             'sources': [{'file': os.path.abspath(fname), 'blob': digests[fname]} for fname in source_list]},
+            {digests[fname]: content for fname, content in contents.items()})
+
+
+def store_blobs(config: Mapping[str, Any], blobs: Dict[str, str]) -> None:
+    for content in blobs.values():
+        store_blob(config, content)
+
+
+def source_mode(config: Mapping[str, Any]) -> str:
+    mode = config.get('sources') or DEFAULT_SOURCE_MODE
+    if mode not in SOURCE_MODES:
+        raise ValueError(f"unknown sources mode '{mode}', use one of {', '.join(SOURCE_MODES)}")
+    return mode
+
+
+def full_question(data: Dict[str, Any], config: Mapping[str, Any]) -> str:
+    # the question with the content of all of its sources
+    if not data.get('sources'):
+        return data['question']
+    return expand_sources(data, config, lambda file, blob: None)
+
+
+def expand_sources(data: Dict[str, Any],
+                   config: Mapping[str, Any],
+                   omit: Callable[[str, str], Optional[str]]
+                   ) -> str:
+    # omit(file, blob) returns the text sent instead of a source, or None
+    files = {source['blob']: source['file'] for source in data['sources']}
+    lines = data['question'].split('\n')
+    for pos, line in enumerate(lines):
+        blob = line[len(BLOB_REF):]
+        if not line.startswith(BLOB_REF) or blob not in files:
+            continue
+        file = files[blob]
+        note = omit(file, blob)
+        content = read_blob(config, blob) if note is None else note
+        lines[pos] = content if content is not None else f'(the content of {file} is not available)'
+    return '\n'.join(lines)
+
+
+def latest_versions(history: List[Dict[str, Any]], current: List[Dict[str, str]]) -> Dict[str, Optional[str]]:
+    # file -> blob of its last version in the history, None for the files
+    # sent with the current question
+    latest: Dict[str, Optional[str]] = {}
+    for data in history:
+        for source in data.get('sources') or []:
+            latest[source['file']] = source['blob']
+    for source in current:
+        latest[source['file']] = None
+    return latest
+
+
+# Decides which sources of the history are sent, the other ones are
+# replaced by a note.
+class SourceFilter:
+
+    def __init__(self,
+                 mode: str,
+                 current: List[Dict[str, str]],
+                 latest: Optional[Dict[str, Optional[str]]] = None
+                 ) -> None:
+        self.mode = mode
+        # the sources of the current question are sent with it
+        self.later = {source['blob'] for source in current}
+        self.latest = latest
+        self.seen: Set[str] = set()
+
+    def omit(self, file: str, blob: str) -> Optional[str]:
+        if self.mode == 'all':
+            return None
+        if blob in self.seen:
+            return f'(the content of {file} as above)'
+        if blob in self.later:
+            return f'(the content of {file} follows)'
+        if self.latest is not None and self.latest.get(file) != blob:
+            return f'(an older version of {file}, the current one follows)'
+        self.seen.add(blob)
+        return None
+
+
+def with_sources(history: Iterable[Dict[str, Any]],
+                 config: Mapping[str, Any],
+                 current: Optional[List[Dict[str, str]]] = None
+                 ) -> Iterator[Dict[str, Any]]:
+    # replaces the references of the history by the sources
+    mode = source_mode(config)
+    latest = None
+    if mode == 'latest':
+        history = list(history)
+        latest = latest_versions(history, current or [])
+    source_filter = SourceFilter(mode, current or [], latest)
+    for data in history:
+        if data.get('sources'):
+            data = {**data, 'question': expand_sources(data, config, source_filter.omit)}
+        yield data
+
+
+def copy_blobs(config: Mapping[str, Any], target_config: Mapping[str, Any]) -> None:
+    import shutil
+    source, target = blob_dir(config), blob_dir(target_config)
+    if source.is_dir() and source.resolve() != target.resolve():
+        shutil.copytree(source, target, dirs_exist_ok=True)
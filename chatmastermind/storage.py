@@ -1,84 +1,314 @@
-import yaml
-import io
-import pathlib
-from .utils import terminal_width, append_message, message_to_chat
-from typing import List, Dict, Any, Optional
+from .utils import terminal_width, make_message
+from .backend import Backend, open_backend
+from .sources import full_question, with_sources, store_blobs
+from .tokens import encoding_name, message_tokens, history_budget
+from .metrics import phase, count
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple, Mapping
+
+# answers read at once when the history is consumed lazily, large enough
+# for the parallel parsing of the YAML backend to pay off
+HISTORY_CHUNK_SIZE = 2000
+
+
+def new_group() -> str:
+    # the answers saved together, not their numbers, which may still change
+    # while they are written
+    import secrets
+    return secrets.token_hex(8)
+
+
+def print_answer_title(inum: int) -> None:
+    title = f'-- ANSWER {inum} '
+    title_end = '-' * (terminal_width() - len(title))
+    print(f'{title}{title_end}')
 
 
 def save_answers(question: str,
                  answers: list[str],
                  tags: list[str],
                  otags: Optional[list[str]],
-                 config: Dict[str, Any]
-                 ) -> None:
+                 config: Mapping[str, Any],
+                 update_index: bool = True,
+                 extra: Optional[Dict[str, Any]] = None,
+                 blobs: Optional[Dict[str, str]] = None
+                 ) -> int:
+    # extra: further keys of the answers, e.g. the question with references
+    # to its sources or their group, blobs: the sources it refers to,
+    # returns the number of the first answer
     wtags = otags or tags
-    num, inum = 0, 0
-    next_fname = pathlib.Path(config['db']) / '.next'
-    try:
-        with open(next_fname, 'r') as f:
-            num = int(f.read())
-    except Exception:
-        pass
-    for answer in answers:
-        num += 1
-        inum += 1
-        title = f'-- ANSWER {inum} '
-        title_end = '-' * (terminal_width() - len(title))
-        print(f'{title}{title_end}')
-        print(answer)
-        with open(f"{num:04d}.yaml", "w") as fd:
-            with io.StringIO() as f:
-                yaml.dump({'question': question},
-                          f,
-                          default_style="|",
-                          default_flow_style=False)
-                fd.write(f.getvalue().replace('"question":', "question:", 1))
-            with io.StringIO() as f:
-                yaml.dump({'answer': answer},
-                          f,
-                          default_style="|",
-                          default_flow_style=False)
-                fd.write(f.getvalue().replace('"answer":', "answer:", 1))
-            yaml.dump({'tags': wtags},
-                      fd,
-                      default_flow_style=False)
-    with open(next_fname, 'w') as f:
-        f.write(f'{num}')
+    group = new_group()
+    with phase('save'):
+        store_blobs(config, blobs or {})
+        backend = open_backend(config)
+        num = backend.reserve(len(answers))
+        for inum, answer in enumerate(answers, start=1):
+            print_answer_title(inum)
+            print(answer)
+        # a single transaction or sync for all answers
+        nums = backend.write_many([(num + index, {'question': question, 'answer': answer, 'tags': wtags, 'group': group,
+                                                  **(extra or {})})
+                                   for index, answer in enumerate(answers)])
+        if update_index:
+            backend.refresh()
+    return nums[0]
+
+
+# Prints streamed answers while they arrive and saves every answer as soon
+# as it is complete. Only one answer is printed live, the deltas of the
+# other ones are buffered until it is their turn.
+class AnswerStream:
+
+    def __init__(self,
+                 question: str,
+                 tags: list[str],
+                 otags: Optional[list[str]],
+                 config: Mapping[str, Any],
+                 number: int,
+                 extra: Optional[Dict[str, Any]] = None,
+                 blobs: Optional[Dict[str, str]] = None
+                 ) -> None:
+        self.question = question
+        self.tags = otags or tags
+        self.extra = {'group': new_group(), **(extra or {})}
+        self.config = config
+        # stored with the first answer
+        self.blobs = blobs
+        self.backend = open_backend(config)
+        self.first_num = self.backend.reserve(number)
+        self.buffers: list[list[str]] = [[] for _ in range(number)]
+        self.finished = [False] * number
+        self.shown = 0
+        print_answer_title(1)
+
+    def delta(self, index: int, text: str) -> None:
+        self.buffers[index].append(text)
+        if index == self.shown:
+            print(text, end='', flush=True)
+
+    def done(self, index: int, answer: str) -> None:
+        self.finished[index] = True
+        with phase('save'):
+            if self.blobs:
+                store_blobs(self.config, self.blobs)
+                self.blobs = None
+            self.backend.write(self.first_num + index, {'question': self.question, 'answer': answer, 'tags': self.tags,
+                                                        **self.extra})
+        while self.shown < len(self.finished) and self.finished[self.shown]:
+            print()
+            self.shown += 1
+            if self.shown < len(self.finished):
+                print_answer_title(self.shown + 1)
+                print(''.join(self.buffers[self.shown]), end='', flush=True)
+        if self.shown == len(self.finished):
+            with phase('save'):
+                self.backend.refresh()
+
+
+def is_summary(name: str, loaded: Dict[str, Dict[str, Any]]) -> bool:
+    # summaries only exist in 'loaded', with names of their own
+    return 'summary' in loaded.get(name, {})
+
+
+def answer_tokens(backend: Backend,
+                  names: List[str],
+                  config: Mapping[str, Any],
+                  encoding: str,
+                  loaded: Dict[str, Dict[str, Any]]
+                  ) -> Dict[str, int]:
+    # the token counts are cached by the backend, answers without a count
+    # for this encoding are read once and kept in 'loaded', summaries are
+    # counted as the message they are sent as
+    summaries = [name for name in names if is_summary(name, loaded)]
+    answers = [name for name in names if not is_summary(name, loaded)]
+    tokens = backend.token_counts(answers, encoding)
+    if summaries:
+        from .summary import SUMMARY_PREFIX
+        tokens.update((name, message_tokens(SUMMARY_PREFIX + loaded[name]['summary'], encoding)) for name in summaries)
+    uncounted = [name for name in answers if name not in tokens]
+    counted = {}
+    for name, data in zip(uncounted, backend.read(uncounted)):
+        loaded[name] = data
+        # with all of its sources, at most that is sent
+        counted[name] = message_tokens(full_question(data, config), encoding) + message_tokens(data['answer'], encoding)
+    if counted:
+        backend.store_token_counts(counted, encoding)
+        tokens.update(counted)
+    return tokens
+
+
+def one_per_group(names: List[str], groups: List[Tuple[str, bool]]) -> List[str]:
+    # the selected answer of every group, or its first one
+    chosen: Dict[str, str] = {}
+    for name, (key, selected) in zip(names, groups):
+        if key not in chosen or selected:
+            chosen[key] = name
+    kept = set(chosen.values())
+    return [name for name in names if name in kept]
+
+
+def fit_history(names: List[str],
+                tokens: Dict[str, int],
+                budget: int
+                ) -> List[str]:
+    kept: List[str] = []
+    used = 0
+    for name in reversed(names):
+        if used + tokens[name] > budget:
+            break
+        kept.append(name)
+        used += tokens[name]
+    kept.reverse()
+    return kept
+
+
+def fit_budget(question: str,
+               names: List[str],
+               config: Mapping[str, Any],
+               backend: Backend,
+               loaded: Dict[str, Dict[str, Any]],
+               stats: Optional[Dict[str, int]] = None
+               ) -> List[str]:
+    encoding = encoding_name(config.get('openai', {}).get('model', ''))
+    chat_tokens = message_tokens(config['system'].strip(), encoding) + message_tokens(question, encoding)
+    budget = history_budget(chat_tokens, config)
+    if budget is None:
+        return names
+    tokens = answer_tokens(backend, names, config, encoding, loaded)
+    kept = fit_history(names, tokens, budget)
+    if stats is not None:
+        # a summary is a single message
+        dropped = names[:len(names) - len(kept)]
+        stats['history_tokens'] = sum(tokens[name] for name in kept)
+        stats['dropped_messages'] = sum(1 if is_summary(name, loaded) else 2 for name in dropped)
+        stats['dropped_tokens'] = sum(tokens.values()) - stats['history_tokens']
+    return kept
+
+
+def select_history(question: Optional[str],
+                   tags: Optional[List[str]],
+                   extags: Optional[List[str]],
+                   config: Mapping[str, Any],
+                   backend: Backend,
+                   loaded: Dict[str, Dict[str, Any]],
+                   stats: Optional[Dict[str, int]] = None
+                   ) -> List[str]:
+    names = backend.select(tags, extags)
+    count('files_scanned', len(backend))
+    count('files_matched', len(names))
+    # every question once, with the selected answer
+    names = one_per_group(names, backend.groups(names))
+    if not question:
+        # -d and -D show the full history
+        return names
+    summaries: List[str] = []
+    if config.get('summary'):
+        # older answers are replaced by their summaries, in blocks of all
+        # matching answers, before the relevant ones are picked or the
+        # history is fitted into the budget
+        from .summary import compact_history
+        summaries, names = compact_history(backend, names, loaded, config)
+    if config.get('relevant'):
+        # the most relevant answers instead of all matching ones
+        with phase('search'):
+            names = backend.search(question, names, config['relevant'])
+    names = fit_budget(question, summaries + names, config, backend, loaded, stats)
+    if summaries and stats is not None:
+        stats['summarized_messages'] = sum(2 * loaded[name]['pairs'] for name in names if is_summary(name, loaded))
+    return names
+
+
+def load_history(backend: Backend,
+                 names: List[str],
+                 loaded: Dict[str, Dict[str, Any]]
+                 ) -> None:
+    unloaded = [name for name in names if name not in loaded]
+    loaded.update(zip(unloaded, backend.read(unloaded)))
+
+
+def iter_history(backend: Backend,
+                 names: List[str],
+                 loaded: Dict[str, Dict[str, Any]]
+                 ) -> Iterator[Dict[str, Any]]:
+    # reads the answers in chunks while they are used
+    for pos in range(0, len(names), HISTORY_CHUNK_SIZE):
+        chunk = names[pos:pos + HISTORY_CHUNK_SIZE]
+        unloaded = [name for name in chunk if name not in loaded]
+        read = dict(zip(unloaded, backend.read(unloaded))) if unloaded else {}
+        for name in chunk:
+            yield loaded[name] if name in loaded else read[name]
+
+
+def chat_messages(question: Optional[str],
+                  config: Mapping[str, Any],
+                  history: Iterable[Dict[str, Any]],
+                  sources: Optional[List[Dict[str, str]]] = None
+                  ) -> Iterator[Dict[str, str]]:
+    # sources: those sent with the question
+    yield make_message('system', config['system'].strip())
+    for data in with_sources(history, config, sources):
+        if 'summary' in data:
+            from .summary import SUMMARY_PREFIX
+            yield make_message('system', SUMMARY_PREFIX + data['summary'])
+            continue
+        yield make_message('user', data['question'])
+        yield make_message('assistant', data['answer'])
+    if question:
+        yield make_message('user', question)
+
+
+def build_chat(question: Optional[str],
+               config: Mapping[str, Any],
+               history: Iterable[Dict[str, Any]],
+               sources: Optional[List[Dict[str, str]]] = None
+               ) -> List[Dict[str, str]]:
+    return list(chat_messages(question, config, history, sources))
+
+
+def iter_chat(question: Optional[str],
+              tags: Optional[List[str]],
+              extags: Optional[List[str]],
+              config: Mapping[str, Any],
+              stats: Optional[Dict[str, int]] = None,
+              sources: Optional[List[Dict[str, str]]] = None
+              ) -> Iterator[Dict[str, str]]:
+    # the history is selected at once, but only read while the messages
+    # are consumed
+    backend = open_backend(config)
+    loaded: Dict[str, Dict[str, Any]] = {}
+    names = select_history(question, tags, extags, config, backend, loaded, stats)
+    return chat_messages(question, config, iter_history(backend, names, loaded), sources)
 
 
 def create_chat(question: Optional[str],
                 tags: Optional[List[str]],
                 extags: Optional[List[str]],
-                config: Dict[str, Any]
+                config: Mapping[str, Any],
+                stats: Optional[Dict[str, int]] = None,
+                sources: Optional[List[Dict[str, str]]] = None
                 ) -> List[Dict[str, str]]:
-    chat = []
-    append_message(chat, 'system', config['system'].strip())
-    for file in sorted(pathlib.Path(config['db']).iterdir()):
-        if file.suffix == '.yaml':
-            with open(file, 'r') as f:
-                data = yaml.load(f, Loader=yaml.FullLoader)
-            data_tags = set(data.get('tags', []))
-            tags_match = \
-                not tags or data_tags.intersection(tags)
-            extags_do_not_match = \
-                not extags or not data_tags.intersection(extags)
-            if tags_match and extags_do_not_match:
-                message_to_chat(data, chat)
-    if question:
-        append_message(chat, 'user', question)
-    return chat
-
-
-def get_tags(config: Dict[str, Any], prefix: Optional[str]) -> List[str]:
-    result = []
-    for file in sorted(pathlib.Path(config['db']).iterdir()):
-        if file.suffix == '.yaml':
-            with open(file, 'r') as f:
-                data = yaml.load(f, Loader=yaml.FullLoader)
-            for tag in data.get('tags', []):
-                if prefix and len(prefix) > 0:
-                    if tag.startswith(prefix):
-                        result.append(tag)
-                else:
-                    result.append(tag)
-    return list(set(result))
+    return list(iter_chat(question, tags, extags, config, stats, sources))
+
+
+def select_answer(config: Mapping[str, Any], num: int) -> int:
+    # marks the answer as the one of its group used in the history, returns
+    # the number of answers in the group
+    backend = open_backend(config)
+    names = backend.names()
+    name = next((name for name in names if backend.number(name) == num), None)
+    if name is None:
+        raise ValueError(f"there is no answer {num}")
+    groups = backend.groups(names)
+    group = groups[names.index(name)][0]
+    members = [member for member, (key, _) in zip(names, groups) if key == group]
+    for member, data in zip(members, backend.read(members)):
+        if bool(data.get('selected')) != (member == name):
+            data = {key: value for key, value in data.items() if key != 'selected'}
+            if member == name:
+                data['selected'] = True
+            backend.update(member, data)
+    backend.refresh()
+    return len(members)
+
+
+def get_tags(config: Mapping[str, Any], prefix: Optional[str]) -> List[str]:
+    return [tag for tag, _ in open_backend(config).tags(prefix)]
@@ -0,0 +1,121 @@
+import json
+import hashlib
+import pathlib
+import importlib
+from typing import List, Dict, Any, Optional, Callable, Mapping, Tuple
+from .utils import write_text
+from .backend import Backend, state_dir
+from .sources import full_question
+from .metrics import phase, count, count_usage
+
+# Replaces the older part of the history of a question by summaries. The
+# older answers of all matching ones are summarized in blocks of a fixed
+# size, counted from the oldest one, so a new answer, the token budget or the
+# relevant answers do not change the blocks. The summary of a block is cached
+# by the hash of its questions and answers.
+
+SUMMARY_DIR = '.summaries'
+DEFAULT_KEEP = 4
+DEFAULT_BLOCK = 10
+SUMMARY_PREFIX = 'Summary of earlier questions and answers:\n'
+SUMMARY_PROMPT = ("Summarize the following questions and answers for the context of later questions. "
+                  "Keep all decisions, facts, names and code that later questions may refer to, "
+                  "drop explanations and repetitions.")
+
+Summarizer = Callable[[List[Dict[str, Any]], Mapping[str, Any]], str]
+
+
+def summary_config(config: Mapping[str, Any]) -> Optional[Mapping[str, Any]]:
+    # opt-in, 'summary: true' enables it with the defaults
+    summary = config.get('summary')
+    if not summary:
+        return None
+    return summary if isinstance(summary, Mapping) else {}
+
+
+def summary_dir(config: Mapping[str, Any], summary: Mapping[str, Any]) -> pathlib.Path:
+    return pathlib.Path(summary.get('dir') or state_dir(config) / SUMMARY_DIR)
+
+
+def summarize_with_ai(pairs: List[Dict[str, Any]], config: Mapping[str, Any]) -> str:
+    from .api_client import ai
+    text = '\n\n'.join(f"QUESTION: {data['question']}\nANSWER: {data['answer']}" for data in pairs)
+    chat = [{'role': 'system', 'content': SUMMARY_PROMPT}, {'role': 'user', 'content': text}]
+    answers, usage = ai(chat, config, 1)
+    count_usage(usage)
+    return answers[0]
+
+
+def load_summarizer(spec: Any) -> Summarizer:
+    # a function or its name, 'package.module:function' or 'package.module.function'
+    if spec is None:
+        return summarize_with_ai
+    if callable(spec):
+        return spec
+    module, _, name = spec.rpartition(':') if ':' in spec else spec.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+
+def summarizer_name(spec: Any) -> str:
+    if spec is None or isinstance(spec, str):
+        return spec or 'ai'
+    return f"{getattr(spec, '__module__', '')}.{getattr(spec, '__qualname__', type(spec).__name__)}"
+
+
+def summary_key(pairs: List[Dict[str, Any]], config: Mapping[str, Any], summary: Mapping[str, Any]) -> str:
+    data = {'summarizer': summarizer_name(summary.get('summarizer')),
+            'model': config.get('openai', {}).get('model'),
+            'pairs': [[data['question'], data['answer']] for data in pairs]}
+    return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+
+def block_summary(key: str,
+                  pairs: List[Dict[str, Any]],
+                  config: Mapping[str, Any],
+                  summary: Mapping[str, Any]
+                  ) -> str:
+    directory = summary_dir(config, summary)
+    fname = directory / f'{key}.txt'
+    try:
+        with open(fname, 'r') as f:
+            return f.read()
+    except OSError:
+        pass
+    # the summarizer gets the questions with their sources
+    pairs = [{**data, 'question': full_question(data, config)} for data in pairs]
+    text = load_summarizer(summary.get('summarizer'))(pairs, config).strip()
+    count('blocks_summarized')
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return text
+    write_text(fname, text)
+    return text
+
+
+def compact_history(backend: Backend,
+                    names: List[str],
+                    loaded: Dict[str, Dict[str, Any]],
+                    config: Mapping[str, Any]
+                    ) -> Tuple[List[str], List[str]]:
+    # returns the names of the summaries and of the answers after them, the
+    # summaries are added to 'loaded' with the number of their pairs
+    summary = summary_config(config)
+    if summary is None:
+        return [], names
+    block = summary.get('block', DEFAULT_BLOCK)
+    old = names[:max(len(names) - summary.get('keep', DEFAULT_KEEP), 0) // block * block]
+    if not old:
+        return [], names
+    unloaded = [name for name in old if name not in loaded]
+    read = dict(zip(unloaded, backend.read(unloaded)))
+    pairs = [loaded[name] if name in loaded else read[name] for name in old]
+    summaries = []
+    with phase('summarize'):
+        for pos in range(0, len(pairs), block):
+            key = summary_key(pairs[pos:pos + block], config, summary)
+            name = f'summary:{key}'
+            if name not in loaded:
+                loaded[name] = {'summary': block_summary(key, pairs[pos:pos + block], config, summary), 'pairs': block}
+            summaries.append(name)
+    return summaries, names[len(old):]
@@ -0,0 +1,69 @@
+import json
+import pathlib
+from bisect import bisect_left
+from .utils import write_json
+from typing import List, Dict, Any, Optional, Tuple
+
+# this module is used by the tab completion, keep its imports cheap
+
+
+TAGS_FILE = '.tags.json'
+TAGS_VERSION = 1
+
+
+def tags_path(db: pathlib.Path) -> pathlib.Path:
+    return db / TAGS_FILE
+
+
+def count_tags(files: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for entry in files.values():
+        for tag in set(entry['tags']):
+            counts[tag] = counts.get(tag, 0) + 1
+    return counts
+
+
+def sorted_tags(files: Dict[str, Dict[str, Any]]) -> Tuple[List[str], List[int]]:
+    counts = count_tags(files)
+    tags = sorted(counts)
+    return tags, [counts[tag] for tag in tags]
+
+
+def write_tag_store(db: pathlib.Path, files: Dict[str, Dict[str, Any]]) -> None:
+    tags, counts = sorted_tags(files)
+    write_json(tags_path(db), {'version': TAGS_VERSION, 'tags': tags, 'counts': counts})
+
+
+def read_tag_store(db: pathlib.Path) -> Optional[Tuple[List[str], List[int]]]:
+    try:
+        with open(tags_path(db), 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != TAGS_VERSION:
+        return None
+    return data['tags'], data['counts']
+
+
+def find_tags(tags: List[str],
+              counts: List[int],
+              prefix: Optional[str]
+              ) -> List[Tuple[str, int]]:
+    result = []
+    prefix = prefix or ''
+    for pos in range(bisect_left(tags, prefix), len(tags)):
+        if not tags[pos].startswith(prefix):
+            break
+        result.append((tags[pos], counts[pos]))
+    return result
+
+
+def complete_tags(db: pathlib.Path, prefix: Optional[str]) -> List[str]:
+    store = read_tag_store(db)
+    if store is None:
+        # no tag store yet, building the index creates it
+        from .index import load_index
+        store = sorted_tags(load_index(db))
+    matches = find_tags(*store, prefix)
+    matches.sort(key=lambda match: -match[1])
+    return [tag for tag, _ in matches]
@@ -0,0 +1,64 @@
+from typing import Dict, Any, Optional, Mapping
+
+# tiktoken is optional, without it the number of tokens is estimated
+# from the length of the text
+
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+CHARS_PER_TOKEN = 4
+ESTIMATE = 'estimate'
+
+CONTEXT_WINDOWS = {
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+}
+
+_encodings: Dict[str, Any] = {}
+
+
+def encoding_name(model: str) -> str:
+    try:
+        import tiktoken  # type: ignore[import-not-found]
+    except ImportError:
+        return ESTIMATE
+    try:
+        return tiktoken.encoding_for_model(model).name
+    except KeyError:
+        return 'cl100k_base'
+
+
+def count_tokens(text: str, encoding: str) -> int:
+    if encoding == ESTIMATE:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    if encoding not in _encodings:
+        import tiktoken  # type: ignore[import-not-found]
+        _encodings[encoding] = tiktoken.get_encoding(encoding)
+    return len(_encodings[encoding].encode(text, disallowed_special=()))
+
+
+def message_tokens(content: str, encoding: str) -> int:
+    return TOKENS_PER_MESSAGE + count_tokens(content, encoding)
+
+
+def context_window(model: str, config: Mapping[str, Any]) -> Optional[int]:
+    if config.get('context_window'):
+        return int(config['context_window'])
+    # longest matching prefix, e.g. 'gpt-4-0613' uses the window of 'gpt-4'
+    for name in sorted(CONTEXT_WINDOWS, key=len, reverse=True):
+        if model.startswith(name):
+            return CONTEXT_WINDOWS[name]
+    return None
+
+
+def history_budget(chat_tokens: int, config: Mapping[str, Any]) -> Optional[int]:
+    openai_config = config.get('openai', {})
+    window = context_window(openai_config.get('model', ''), openai_config)
+    limit = openai_config.get('history_tokens')
+    if window is not None:
+        window -= chat_tokens + TOKENS_PER_REPLY + openai_config.get('max_tokens', 0)
+        limit = window if limit is None else min(limit, window)
+    return None if limit is None else max(limit, 0)
@@ -1,13 +1,49 @@
+import os
+import json
 import shutil
-from pprint import PrettyPrinter
-from typing import List, Dict
+import pathlib
+import threading
+from typing import List, Dict, Any, Optional, Callable
+
+# use the libyaml bindings when they are available, they are much faster
+try:
+    from yaml import CFullLoader as YamlLoader, CSafeLoader as YamlSafeLoader, CDumper as YamlDumper
+except ImportError:
+    from yaml import FullLoader as YamlLoader, SafeLoader as YamlSafeLoader, Dumper as YamlDumper  # type: ignore # noqa: F401
+
+
+# the daemon renders for the terminal of the client of every thread
+_local = threading.local()
+
+
+def set_terminal_width(width: Optional[int]) -> None:
+    _local.width = width
 
 
 def terminal_width() -> int:
-    return shutil.get_terminal_size().columns
+    return getattr(_local, 'width', None) or shutil.get_terminal_size().columns
+
+
+def write_json(fname: pathlib.Path, data: Any) -> None:
+    write_text(fname, json.dumps(data, separators=(',', ':')))
+
+
+def write_text(fname: pathlib.Path, text: str) -> None:
+    tmp_fname = fname.with_name(f'{fname.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_fname, 'w') as f:
+            f.write(text)
+        os.replace(tmp_fname, fname)
+    except OSError:
+        # only used for caches, a read-only db still works without them
+        try:
+            os.unlink(tmp_fname)
+        except OSError:
+            pass
 
 
 def pp(*args, **kwargs) -> None:
+    from pprint import PrettyPrinter
     return PrettyPrinter(width=terminal_width()).pprint(*args, **kwargs)
 
 
@@ -26,11 +62,39 @@ def process_tags(tags: list[str], extags: list[str], otags: list[str]) -> None:
         print()
 
 
+def read_source(fname: str) -> str:
+    with open(fname) as r:
+        return r.read().strip()
+
+
+def compose_question(question_list: List[str],
+                     source_list: List[str],
+                     read: Callable[[str], str] = read_source
+                     ) -> str:
+    question_parts = []
+
+    for question, source in zip(question_list, source_list):
+        question_parts.append(f"{question}\n\n```\n{read(source)}\n```")
+
+    if len(question_list) > len(source_list):
+        for question in question_list[len(source_list):]:
+            question_parts.append(question)
+    else:
+        for source in source_list[len(question_list):]:
+            question_parts.append(f"```\n{read(source)}\n```")
+
+    return '\n\n'.join(question_parts)
+
+
+def make_message(role: str, content: str) -> Dict[str, str]:
+    return {'role': role, 'content': content.replace("''", "'")}
+
+
 def append_message(chat: List[Dict[str, str]],
                    role: str,
                    content: str
                    ) -> None:
-    chat.append({'role': role, 'content': content.replace("''", "'")})
+    chat.append(make_message(role, content))
 
 
 def message_to_chat(message: Dict[str, str],
@@ -38,26 +102,3 @@ def message_to_chat(message: Dict[str, str],
                     ) -> None:
     append_message(chat, 'user', message['question'])
     append_message(chat, 'assistant', message['answer'])
-
-
-def display_chat(chat, dump=False, source_code=False) -> None:
-    if dump:
-        pp(chat)
-        return
-    for message in chat:
-        if message['role'] == 'user' and not source_code:
-            print('-' * (terminal_width()))
-        if len(message['content']) > terminal_width() - len(message['role']) - 2:
-            if not source_code:
-                print(f"{message['role'].upper()}:")
-            if source_code:
-                out = 0
-                for line in message['content'].splitlines():
-                    if line.strip().startswith('```'):
-                        out += 1
-                    elif out == 1:
-                        print(f"{line}")
-            else:
-                print(message['content'])
-        elif not source_code:
-            print(f"{message['role'].upper()}: {message['content']}")
@@ -0,0 +1,129 @@
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Optional, Any
+
+
+# A local stand-in for the chat completions endpoint of the OpenAI API,
+# it supports plain and streamed ('stream': true) requests. Point the
+# client to it with 'openai.api_base = server.api_base'.
+
+
+def default_answers(request: dict[str, Any]) -> list[str]:
+    question = request['messages'][-1]['content']
+    return [f'answer {num} to: {question}' for num in range(1, request.get('n', 1) + 1)]
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    server: 'FakeOpenAIServer'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(request)
+        if self.server.failures:
+            self.send_error_response(*self.server.failures.pop(0))
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        answers = self.server.answers(request)
+        usage = {'prompt_tokens': sum(count_words(m['content']) for m in request['messages']),
+                 'completion_tokens': sum(count_words(a) for a in answers)}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        if request.get('stream'):
+            self.send_stream(request, answers, usage)
+        else:
+            self.send_json({'id': 'chatcmpl-fake', 'object': 'chat.completion',
+                            'model': request['model'],
+                            'choices': [{'index': index,
+                                         'message': {'role': 'assistant', 'content': answer},
+                                         'finish_reason': 'stop'}
+                                        for index, answer in enumerate(answers)],
+                            'usage': usage})
+
+    def send_error_response(self, status: int, headers: dict[str, str]) -> None:
+        body = json.dumps({'error': {'message': f'fake error {status}', 'type': 'fake'}}).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data: dict[str, Any]) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, data: Any) -> None:
+        payload = data if isinstance(data, str) else json.dumps(data)
+        self.wfile.write(f'data: {payload}\n\n'.encode())
+        self.wfile.flush()
+
+    def send_stream(self, request: dict[str, Any], answers: list[str], usage: dict[str, int]) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        # the choices are interleaved word by word, like the real API does
+        words = [answer.split(' ') for answer in answers]
+        for pos in range(max(len(w) for w in words) + 1):
+            for index, answer_words in enumerate(words):
+                if pos < len(answer_words):
+                    content = answer_words[pos] if pos == 0 else ' ' + answer_words[pos]
+                    choice = {'index': index, 'delta': {'content': content}, 'finish_reason': None}
+                elif pos == len(answer_words):
+                    choice = {'index': index, 'delta': {}, 'finish_reason': 'stop'}
+                else:
+                    continue
+                self.send_event({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk',
+                                 'model': request['model'], 'choices': [choice]})
+                if self.server.token_latency:
+                    time.sleep(self.server.token_latency)
+        if request.get('stream_options', {}).get('include_usage'):
+            self.send_event({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk',
+                             'model': request['model'], 'choices': [], 'usage': usage})
+        self.send_event('[DONE]')
+        self.close_connection = True
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self,
+                 answers: Optional[Callable[[dict[str, Any]], list[str]]] = None,
+                 latency: float = 0.0,
+                 token_latency: float = 0.0
+                 ) -> None:
+        super().__init__(('127.0.0.1', 0), FakeOpenAIHandler)
+        self.answers = answers or default_answers
+        self.latency = latency
+        self.token_latency = token_latency
+        self.requests: list[dict[str, Any]] = []
+        # (status, headers) of error responses sent before the next answers
+        self.failures: list[tuple[int, dict[str, str]]] = []
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def api_base(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+    def __enter__(self) -> 'FakeOpenAIServer':
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown()
+        self.server_close()
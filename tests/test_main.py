@@ -1,33 +1,63 @@
-import unittest
+import os
+import sys
+import json
+import random
+import time
 import io
+import unittest
+import threading
+import tempfile
+import subprocess
 import pathlib
 import yaml
+import openai
 import argparse
 from chatmastermind.utils import terminal_width
-from chatmastermind.main import create_parser, handle_question
-from chatmastermind.api_client import ai
-from chatmastermind.storage import create_chat, save_answers
+from chatmastermind.main import create_parser, handle_question, main, apply_overrides
+from chatmastermind.config import load_config, with_overrides, db_path, sampling_params
+from chatmastermind import metrics
+from chatmastermind.api_client import ai, ai_stream
+from chatmastermind.storage import create_chat, iter_chat, save_answers, get_tags, fit_history, AnswerStream
+from chatmastermind.tokens import context_window, history_budget
+from chatmastermind.batch import read_batch, run_batch
+from chatmastermind.fanout import history_config
+from chatmastermind.cache import cache_key, cached_ai, evict
+from chatmastermind.scheduler import TokenBucket, RateLimiter, retry_after, throttle_stats
+from chatmastermind.index import load_index, select_files, parse_answer_file, parse_answer_files
+from chatmastermind.tags import find_tags, complete_tags
+from chatmastermind.backend import Backend, YamlBackend, SqliteBackend, open_backend, migrate
+from chatmastermind.fts import FullTextIndex, FullTextStore, top_relevant
+from chatmastermind.daemon import socket_path, complete_remote, absolute_paths
+from chatmastermind.render import render_chat, render_dump, display_chat
+from chatmastermind.sources import compose_sources, read_blob, store_blob
 from unittest import mock
+from contextlib import redirect_stdout, redirect_stderr
+from tests.fake_openai import FakeOpenAIServer
 from unittest.mock import patch, MagicMock, Mock
 
 
 class TestCreateChat(unittest.TestCase):
 
     def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
         self.config = {
             'system': 'System text',
-            'db': 'test_files'
+            'db': self.tmpdir.name
         }
         self.question = "test question"
         self.tags = ['test_tag']
 
-    @patch('os.listdir')
-    @patch('builtins.open')
-    def test_create_chat_with_tags(self, open_mock, listdir_mock):
-        listdir_mock.return_value = ['testfile.yaml']
-        open_mock.return_value.__enter__.return_value = io.StringIO(yaml.dump(
-            {'question': 'test_content', 'answer': 'some answer',
-             'tags': ['test_tag']}))
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_answer(self, name, data):
+        with open(pathlib.Path(self.tmpdir.name) / name, 'w') as f:
+            yaml.dump(data, f)
+
+    def test_create_chat_with_tags(self):
+        self.write_answer('testfile.yaml',
+                          {'question': 'test_content', 'answer': 'some answer',
+                           'tags': ['test_tag']})
 
         test_chat = create_chat(self.question, self.tags, None, self.config)
 
@@ -41,13 +71,10 @@ class TestCreateChat(unittest.TestCase):
         self.assertEqual(test_chat[3],
                          {'role': 'user', 'content': self.question})
 
-    @patch('os.listdir')
-    @patch('builtins.open')
-    def test_create_chat_with_other_tags(self, open_mock, listdir_mock):
-        listdir_mock.return_value = ['testfile.yaml']
-        open_mock.return_value.__enter__.return_value = io.StringIO(yaml.dump(
-            {'question': 'test_content', 'answer': 'some answer',
-             'tags': ['other_tag']}))
+    def test_create_chat_with_other_tags(self):
+        self.write_answer('testfile.yaml',
+                          {'question': 'test_content', 'answer': 'some answer',
+                           'tags': ['other_tag']})
 
         test_chat = create_chat(self.question, self.tags, None, self.config)
 
@@ -57,18 +84,13 @@ class TestCreateChat(unittest.TestCase):
         self.assertEqual(test_chat[1],
                          {'role': 'user', 'content': self.question})
 
-    @patch('os.listdir')
-    @patch('builtins.open')
-    def test_create_chat_without_tags(self, open_mock, listdir_mock):
-        listdir_mock.return_value = ['testfile.yaml', 'testfile2.yaml']
-        open_mock.side_effect = (
-            io.StringIO(yaml.dump({'question': 'test_content',
-                                   'answer': 'some answer',
-                                   'tags': ['test_tag']})),
-            io.StringIO(yaml.dump({'question': 'test_content2',
-                                   'answer': 'some answer2',
-                                   'tags': ['test_tag2']})),
-        )
+    def test_create_chat_without_tags(self):
+        self.write_answer('testfile.yaml',
+                          {'question': 'test_content', 'answer': 'some answer',
+                           'tags': ['test_tag']})
+        self.write_answer('testfile2.yaml',
+                          {'question': 'test_content2', 'answer': 'some answer2',
+                           'tags': ['test_tag2']})
 
         test_chat = create_chat(self.question, [], None, self.config)
 
@@ -84,6 +106,440 @@ class TestCreateChat(unittest.TestCase):
         self.assertEqual(test_chat[4],
                          {'role': 'assistant', 'content': 'some answer2'})
 
+    def test_create_chat_parses_only_matching_files(self):
+        self.write_answer('0001.yaml',
+                          {'question': 'q1', 'answer': 'a1', 'tags': ['test_tag']})
+        self.write_answer('0002.yaml',
+                          {'question': 'q2', 'answer': 'a2', 'tags': ['other_tag']})
+        create_chat(self.question, self.tags, None, self.config)
+
+        with patch('chatmastermind.index.parse_answer_file',
+                   wraps=parse_answer_file) as parse_mock:
+            test_chat = create_chat(self.question, self.tags, None, self.config)
+        parse_mock.assert_called_once_with(pathlib.Path(self.tmpdir.name) / '0001.yaml')
+        self.assertEqual(len(test_chat), 4)
+
+    def test_iter_chat_reads_history_lazily(self):
+        for num in range(1, 4):
+            self.write_answer(f'{num:04d}.yaml',
+                              {'question': f'q{num}', 'answer': f'a{num}', 'tags': ['test_tag']})
+        create_chat(self.question, self.tags, None, self.config)
+
+        with patch('chatmastermind.storage.HISTORY_CHUNK_SIZE', 1), \
+                patch('chatmastermind.index.parse_answer_file', wraps=parse_answer_file) as parse_mock:
+            chat = iter_chat(self.question, self.tags, None, self.config)
+            parse_mock.assert_not_called()
+            self.assertEqual(next(chat)['role'], 'system')
+            self.assertEqual(next(chat), {'role': 'user', 'content': 'q1'})
+            parse_mock.assert_called_once_with(pathlib.Path(self.tmpdir.name) / '0001.yaml')
+            rest = list(chat)
+        self.assertEqual(parse_mock.call_count, 3)
+        self.assertEqual(rest[-1], {'role': 'user', 'content': self.question})
+
+
+class TestRender(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = [{'role': 'system', 'content': 'System text'},
+                     {'role': 'user', 'content': 'Write hello world in Python and in C'},
+                     {'role': 'assistant', 'content': 'Python:\n```python\nprint("hello")\n```\n'
+                                                      'C:\n```c\nputs("hello");\n```\n'}]
+
+    def test_render_chat(self):
+        text = ''.join(render_chat(self.chat, 60))
+        self.assertEqual(text, ''.join(['SYSTEM: System text\n',
+                                        '-' * 60 + '\n',
+                                        'USER: Write hello world in Python and in C\n',
+                                        'ASSISTANT:\n' + self.chat[2]['content'] + '\n']))
+
+    def test_render_source_code(self):
+        text = ''.join(render_chat(self.chat, 40, source_code=True))
+        self.assertEqual(text, 'print("hello")\nputs("hello");\n')
+
+    def test_render_dump_like_pprint(self):
+        from pprint import pformat
+        for width in (20, 80, 400):
+            for chat in (self.chat[:1], self.chat, self.chat * 3):
+                self.assertEqual(''.join(render_dump(chat, width)), pformat(chat, width=width) + '\n')
+        # messages that just fit into a line or not
+        rand = random.Random(0)
+        for _ in range(300):
+            width = rand.randint(20, 100)
+            chat = [{'role': rand.choice(['user', 'assistant']),
+                     'content': ''.join(rand.choice('abc ') for _ in range(rand.randint(0, 150)))}
+                    for _ in range(rand.randint(2, 5))]
+            self.assertEqual(''.join(render_dump(chat, width)), pformat(chat, width=width) + '\n')
+
+    def test_display_chat_of_generator(self):
+        out = io.StringIO()
+        with patch('chatmastermind.render.terminal_width', return_value=40) as width_mock:
+            display_chat(iter(self.chat), out=out)
+        width_mock.assert_called_once_with()
+        self.assertEqual(out.getvalue(), ''.join(render_chat(self.chat, 40)))
+
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_answer(self, name, data):
+        with open(self.db / name, 'w') as f:
+            yaml.dump(data, f)
+
+    def test_load_index_is_incremental(self):
+        self.write_answer('0001.yaml', {'question': 'q1', 'answer': 'a1', 'tags': ['t1']})
+        self.write_answer('0002.yaml', {'question': 'q2', 'answer': 'a2', 'tags': ['t2']})
+        files = load_index(self.db)
+        self.assertEqual(list(files), ['0001.yaml', '0002.yaml'])
+        self.assertTrue((self.db / '.index.json').exists())
+
+        self.write_answer('0002.yaml', {'question': 'q2', 'answer': 'a2', 'tags': ['t3', 't4']})
+        (self.db / '0001.yaml').unlink()
+        with patch('chatmastermind.index.parse_answer_file',
+                   wraps=parse_answer_file) as parse_mock:
+            files = load_index(self.db)
+        parse_mock.assert_called_once_with(self.db / '0002.yaml')
+        self.assertEqual(list(files), ['0002.yaml'])
+        self.assertEqual(files['0002.yaml']['tags'], ['t3', 't4'])
+
+    def test_parse_answer_files_keeps_order(self):
+        names = [f'{num:04d}.yaml' for num in range(1, 21)]
+        for num, name in enumerate(names):
+            self.write_answer(name, {'question': f'q{num}', 'answer': f'a{num}', 'tags': []})
+        serial = parse_answer_files(self.db, names, workers=1)
+        with patch('chatmastermind.index.PARALLEL_MIN_FILES', 10):
+            parallel = parse_answer_files(self.db, names, workers=2)
+        self.assertEqual(parallel, serial)
+        self.assertEqual([data['question'] for data in parallel], [f'q{num}' for num in range(20)])
+
+    def test_select_files(self):
+        files = {'a.yaml': {'tags': ['t1']},
+                 'b.yaml': {'tags': ['t1', 't2']},
+                 'c.yaml': {'tags': ['t3']}}
+        self.assertEqual(select_files(files, ['t1'], None), ['a.yaml', 'b.yaml'])
+        self.assertEqual(select_files(files, ['t1'], ['t2']), ['a.yaml'])
+        self.assertEqual(select_files(files, None, ['t1']), ['c.yaml'])
+
+    def test_get_tags(self):
+        self.write_answer('0001.yaml', {'question': 'q1', 'answer': 'a1', 'tags': ['python', 'perl']})
+        self.write_answer('0002.yaml', {'question': 'q2', 'answer': 'a2', 'tags': ['python']})
+        config = {'db': self.tmpdir.name}
+        self.assertEqual(sorted(get_tags(config, None)), ['perl', 'python'])
+        self.assertEqual(get_tags(config, 'py'), ['python'])
+
+    def test_refresh_keeps_index_in_memory(self):
+        self.write_answer('0001.yaml', {'question': 'q1', 'answer': 'a1', 'tags': ['python']})
+        backend = YamlBackend(pathlib.Path(self.tmpdir.name))
+        backend.search('q1', backend.names(), 1)
+        with patch('chatmastermind.index.read_index') as read_mock, \
+                patch.object(FullTextStore, 'mtimes') as mtimes_mock:
+            backend.refresh()
+        read_mock.assert_not_called()
+        mtimes_mock.assert_not_called()
+        # a new answer is found by the scan of the directory
+        self.write_answer('0002.yaml', {'question': 'q2', 'answer': 'a2', 'tags': ['perl']})
+        with patch('chatmastermind.index.read_index') as read_mock:
+            backend.refresh()
+        read_mock.assert_not_called()
+        self.assertEqual(backend.names(), ['0001.yaml', '0002.yaml'])
+        self.assertEqual(backend.search('q2', backend.names(), 1), ['0002.yaml'])
+
+
+class TestBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name) / 'db'
+        self.db.mkdir()
+        for num, tags in enumerate([['python'], ['perl', 'python'], ['rust']], start=1):
+            with open(self.db / f'{num:04d}.yaml', 'w') as f:
+                yaml.dump({'question': f'q{num}', 'answer': f'a{num}', 'tags': tags}, f)
+        with open(self.db / '.next', 'w') as f:
+            f.write('3')
+        self.sqlite = pathlib.Path(self.tmpdir.name) / 'chat.sqlite'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_sqlite_backend(self):
+        backend = open_backend({'db': str(self.sqlite)})
+        self.assertIsInstance(backend, SqliteBackend)
+        self.assertEqual(migrate(YamlBackend(self.db), backend), 3)
+        self.assertEqual(backend.names(), ['0001', '0002', '0003'])
+        self.assertEqual(backend.select(['python'], None), ['0001', '0002'])
+        self.assertEqual(backend.select(['python'], ['perl']), ['0001'])
+        self.assertEqual(backend.select(None, ['python']), ['0003'])
+        self.assertEqual([data['question'] for data in backend.read(['0003', '0001'])], ['q3', 'q1'])
+        self.assertEqual(backend.tags('p'), [('perl', 1), ('python', 2)])
+        self.assertEqual(backend.complete('p'), ['python', 'perl'])
+        backend.store_token_counts({'0001': 7}, 'estimate')
+        self.assertEqual(backend.token_counts(['0001', '0002'], 'estimate'), {'0001': 7})
+        self.assertEqual(backend.reserve(2), 4)
+        backend.write(4, {'question': 'q4', 'answer': 'a4', 'tags': ['go'], 'model': 'gpt-4'})
+        self.assertEqual(backend.read(['0004']), [{'question': 'q4', 'answer': 'a4', 'tags': ['go'], 'model': 'gpt-4'}])
+
+    def test_order_by_number(self):
+        for num in (9999, 10000, 1001):
+            with open(self.db / f'{num:04d}.yaml', 'w') as f:
+                yaml.dump({'question': f'q{num}', 'answer': f'a{num}', 'tags': ['python']}, f)
+        yaml_backend = YamlBackend(self.db)
+        sqlite_backend = open_backend({'db': str(self.sqlite)})
+        migrate(yaml_backend, sqlite_backend)
+        self.assertEqual(yaml_backend.names(), ['0001.yaml', '0002.yaml', '0003.yaml', '1001.yaml', '9999.yaml', '10000.yaml'])
+        self.assertEqual([yaml_backend.number(name) for name in yaml_backend.select(['python'], None)],
+                         [sqlite_backend.number(name) for name in sqlite_backend.select(['python'], None)])
+        with self.assertRaises(TypeError):
+            Backend()  # type: ignore
+
+    def test_create_chat_from_sqlite(self):
+        config = {'system': 'System text', 'db': str(self.sqlite)}
+        migrate(YamlBackend(self.db), open_backend(config))
+        chat = create_chat('question', ['perl'], None, config)
+        self.assertEqual([m['content'] for m in chat], ['System text', 'q2', 'a2', 'question'])
+
+    def test_migrate_command(self):
+        config = pathlib.Path(self.tmpdir.name) / 'config.yaml'
+        with open(config, 'w') as f:
+            yaml.dump({'system': 'system', 'db': str(self.db)}, f)
+        export = pathlib.Path(self.tmpdir.name) / 'export'
+        for argv in (['cmm', '-c', str(config), '--migrate', str(self.sqlite)],
+                     ['cmm', '-c', str(config), '--migrate', str(export)]):
+            with patch.object(sys, 'argv', argv), redirect_stdout(io.StringIO()) as output:
+                self.assertEqual(main(), 0)
+            self.assertIn('Copied 3 answers', output.getvalue())
+        self.assertEqual(parse_answer_file(export / '0002.yaml'), parse_answer_file(self.db / '0002.yaml'))
+        self.assertEqual(YamlBackend(export).reserve(1), 4)
+        # the target has to be empty
+        with patch.object(sys, 'argv', argv), redirect_stdout(io.StringIO()), \
+             patch('sys.stderr', io.StringIO()), self.assertRaises(SystemExit):
+            main()
+
+
+class TestRelevance(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name) / 'db'
+        self.db.mkdir()
+        self.answers = [('How do I sort a list in Python?', 'Use sorted() or list.sort().'),
+                        ('What is the capital of France?', 'Paris.'),
+                        ('How do I reverse a list in Python?', 'Use reversed() or a slice.'),
+                        ('Which wine goes with cheese?', 'A dry white wine.')]
+        for num, (question, answer) in enumerate(self.answers, start=1):
+            with open(self.db / f'{num:04d}.yaml', 'w') as f:
+                yaml.dump({'question': question, 'answer': answer, 'tags': ['misc']}, f)
+        with open(self.db / '.next', 'w') as f:
+            f.write('4')
+        self.config = {'system': 'System text', 'db': str(self.db), 'relevant': 2}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_full_text_index(self):
+        index = FullTextIndex()
+        for num, (question, answer) in enumerate(self.answers, start=1):
+            index.add(str(num), f'{question}\n{answer}')
+        scores = index.scores('sort a python list')
+        self.assertEqual(max(scores, key=scores.get), '1')
+        self.assertNotIn('2', scores)
+        self.assertEqual(top_relevant(['1', '2', '3', '4'], scores, 2), ['1', '3'])
+
+    def test_create_chat_with_relevant_history(self):
+        chat = create_chat('How do I sort a list in Python?', None, None, self.config)
+        self.assertEqual([m['content'] for m in chat[1::2]],
+                         ['How do I sort a list in Python?', 'How do I reverse a list in Python?',
+                          'How do I sort a list in Python?'])
+        self.assertTrue((self.db / '.fts.sqlite').exists())
+        # answers saved later are added to the index, without writing the others
+        with redirect_stdout(io.StringIO()), \
+                patch.object(FullTextStore, 'update', autospec=True, side_effect=FullTextStore.update) as update_mock:
+            save_answers('What wine goes with fish?', ['A light white wine.'], ['misc'], None, self.config)
+        update_mock.assert_called_once()
+        self.assertEqual([name for name, _, _ in update_mock.call_args.args[2]], ['0005.yaml'])
+        with patch('chatmastermind.backend.parse_answer_files') as parse_mock:
+            names = open_backend(self.config).search('wine for fish', YamlBackend(self.db).names(), 1)
+        parse_mock.assert_not_called()
+        self.assertEqual(names, ['0005.yaml'])
+        # without FTS5 the candidates are indexed in memory
+        backend = YamlBackend(self.db)
+        backend.fts5 = False
+        self.assertEqual(backend.search('wine for fish', backend.names(), 1), ['0005.yaml'])
+
+    def test_sqlite_search(self):
+        sqlite = open_backend({'db': str(pathlib.Path(self.tmpdir.name) / 'chat.sqlite')})
+        migrate(YamlBackend(self.db), sqlite)
+        self.assertEqual(sqlite.search('python list', sqlite.names(), 5), ['0001', '0003'])
+        self.assertEqual(sqlite.search('python list', ['0002', '0003'], 5), ['0003'])
+        sqlite.fts5 = False
+        self.assertEqual(sqlite.search('python list', sqlite.names(), 5), ['0001', '0003'])
+
+
+def summarize_questions(pairs, config):
+    # a deterministic stand-in for the summaries of the API
+    return ', '.join(data['question'] for data in pairs)
+
+
+class TestSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name)
+        for num in range(1, 8):
+            self.write(num, f'q{num}')
+        self.summarizer = Mock(side_effect=summarize_questions)
+        self.config = {'system': 'System text', 'db': self.tmpdir.name,
+                       'summary': {'keep': 2, 'block': 2, 'summarizer': self.summarizer}}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, num, question):
+        with open(self.db / f'{num:04d}.yaml', 'w') as f:
+            yaml.dump({'question': question, 'answer': f'a{num}', 'tags': ['misc']}, f)
+
+    def test_older_answers_are_summarized(self):
+        stats = {}
+        chat = create_chat('question', None, None, self.config, stats=stats)
+        # 7 answers: 2 blocks of 2 are summarized, the last 3 are kept
+        self.assertEqual([m['content'] for m in chat],
+                         ['System text',
+                          'Summary of earlier questions and answers:\nq1, q2',
+                          'Summary of earlier questions and answers:\nq3, q4',
+                          'q5', 'a5', 'q6', 'a6', 'q7', 'a7', 'question'])
+        self.assertEqual(stats['summarized_messages'], 8)
+        self.assertEqual(len(list((self.db / '.summaries').glob('*.txt'))), 2)
+        # the chat without a question shows the whole history
+        self.assertEqual(len(create_chat(None, None, None, self.config)), 15)
+
+    def test_summaries_are_cached(self):
+        create_chat('question', None, None, self.config)
+        self.assertEqual(self.summarizer.call_count, 2)
+        self.write(8, 'q8')
+        create_chat('question', None, None, self.config)
+        # only the new block q5, q6 is summarized
+        self.assertEqual(self.summarizer.call_count, 3)
+        self.write(2, 'q2 changed')
+        chat = create_chat('question', None, None, self.config)
+        self.assertEqual(self.summarizer.call_count, 4)
+        self.assertTrue(chat[1]['content'].endswith('q1, q2 changed'))
+
+    def test_summaries_do_not_change_with_the_budget(self):
+        # the budget only fits a few pairs of the history
+        self.config['openai'] = {'model': 'unknown', 'history_tokens': 60}
+        for num in range(8, 30):
+            self.write(num, f'q{num}')
+            stats = {}
+            chat = create_chat('question', None, None, self.config, stats=stats)
+            # only the blocks completed by the new answers are summarized
+            self.assertEqual(self.summarizer.call_count, (num - 2) // 2)
+            self.assertLessEqual(stats['history_tokens'], 60)
+            self.assertEqual(chat[-3:], [{'role': 'user', 'content': f'q{num}'},
+                                         {'role': 'assistant', 'content': f'a{num}'},
+                                         {'role': 'user', 'content': 'question'}])
+        # the summaries count against the budget, the oldest ones are dropped
+        self.assertEqual([m['content'] for m in chat[:2]], ['System text', 'Summary of earlier questions and answers:\nq25, q26'])
+        self.assertEqual(stats['summarized_messages'], 4)
+        self.assertEqual(stats['dropped_messages'], 12)
+        # nor with the relevant answers of another question
+        self.config['relevant'] = 2
+        create_chat('q3 q20', None, None, self.config)
+        self.assertEqual(self.summarizer.call_count, 13)
+
+    def test_summarizer_by_name(self):
+        self.config['summary']['summarizer'] = 'tests.test_main:summarize_questions'
+        chat = create_chat('question', None, None, self.config)
+        self.assertTrue(chat[1]['content'].endswith('q1, q2'))
+
+
+class TestHistoryBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name)
+        self.config = {
+            'system': 'System text',
+            'db': self.tmpdir.name,
+            'openai': {'model': 'gpt-4', 'max_tokens': 100, 'context_window': 150}
+        }
+        for num in range(1, 5):
+            with open(self.db / f'{num:04d}.yaml', 'w') as f:
+                yaml.dump({'question': f'q{num}', 'answer': 'a' * 80, 'tags': ['tag']}, f)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_context_window(self):
+        self.assertEqual(context_window('gpt-4-0613', {}), 8192)
+        self.assertEqual(context_window('gpt-4-32k-0613', {}), 32768)
+        self.assertEqual(context_window('gpt-4', {'context_window': 1000}), 1000)
+        self.assertIsNone(context_window('unknown', {}))
+
+    def test_history_budget(self):
+        self.assertEqual(history_budget(20, self.config), 150 - 20 - 3 - 100)
+        self.config['openai']['history_tokens'] = 10
+        self.assertEqual(history_budget(20, self.config), 10)
+        self.assertIsNone(history_budget(20, {'openai': {'model': 'unknown'}}))
+
+    def test_fit_history(self):
+        tokens = {'a': 10, 'b': 20, 'c': 5}
+        self.assertEqual(fit_history(['a', 'b', 'c'], tokens, 25), ['b', 'c'])
+        self.assertEqual(fit_history(['a', 'b', 'c'], tokens, 4), [])
+
+    @patch('chatmastermind.storage.encoding_name', return_value='estimate')
+    def test_create_chat_drops_oldest_history(self, _):
+        # every answer costs 29 tokens, the budget for the history is 34 tokens
+        stats = {}
+        chat = create_chat('question', None, None, self.config, stats=stats)
+        self.assertEqual([m['content'] for m in chat if m['role'] == 'user'], ['q4', 'question'])
+        self.assertEqual(stats, {'history_tokens': 29, 'dropped_messages': 6, 'dropped_tokens': 87})
+
+        with patch('chatmastermind.index.parse_answer_file',
+                   wraps=parse_answer_file) as parse_mock:
+            create_chat('question', None, None, self.config)
+        # the token counts are cached, only the answer that fits is parsed
+        parse_mock.assert_called_once_with(self.db / '0004.yaml')
+
+    @patch('chatmastermind.storage.encoding_name', return_value='estimate')
+    def test_chat_without_question_is_not_limited(self, _):
+        stats = {}
+        with patch('chatmastermind.storage.answer_tokens') as tokens_mock:
+            chat = list(iter_chat(None, None, None, self.config, stats=stats))
+        self.assertEqual([m['content'] for m in chat if m['role'] == 'user'], ['q1', 'q2', 'q3', 'q4'])
+        self.assertEqual(stats, {})
+        tokens_mock.assert_not_called()
+
+
+class TestTags(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_find_tags(self):
+        tags = ['c', 'py', 'pyqt', 'python', 'rust']
+        counts = [1, 2, 3, 4, 5]
+        self.assertEqual(find_tags(tags, counts, 'py'), [('py', 2), ('pyqt', 3), ('python', 4)])
+        self.assertEqual(find_tags(tags, counts, 'pz'), [])
+        self.assertEqual(len(find_tags(tags, counts, None)), 5)
+
+    def test_complete_tags_uses_tag_store(self):
+        for num, tags in enumerate([['python'], ['python', 'perl'], ['pyqt']]):
+            with open(self.db / f'{num:04d}.yaml', 'w') as f:
+                yaml.dump({'question': 'q', 'answer': 'a', 'tags': tags}, f)
+        self.assertEqual(complete_tags(self.db, 'py'), ['python', 'pyqt'])
+        self.assertTrue((self.db / '.tags.json').exists())
+        with patch('chatmastermind.index.load_index') as load_index_mock:
+            self.assertEqual(complete_tags(self.db, 'pe'), ['perl'])
+        load_index_mock.assert_not_called()
+
 
 class TestHandleQuestion(unittest.TestCase):
 
@@ -96,71 +552,270 @@ class TestHandleQuestion(unittest.TestCase):
             question=[self.question],
             source=None,
             only_source_code=False,
-            number=3
+            number=3,
+            stream=False,
+            models=None,
+            no_cache=False
         )
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name)
+        with open(self.db / '.next', 'w') as f:
+            f.write('1')
         self.config = {
-            'db': 'test_files',
+            'db': self.tmpdir.name,
             'setting1': 'value1',
             'setting2': 'value2'
         }
 
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
     @patch("chatmastermind.main.create_chat", return_value="test_chat")
     @patch("chatmastermind.main.process_tags")
     @patch("chatmastermind.main.ai", return_value=(["answer1", "answer2", "answer3"], "test_usage"))
-    @patch("chatmastermind.utils.pp")
+    @patch("chatmastermind.main.display_chat")
     @patch("builtins.print")
-    @patch("chatmastermind.storage.yaml.dump")
-    def test_handle_question(self, _, mock_print, mock_pp, mock_ai,
+    def test_handle_question(self, mock_print, mock_display_chat, mock_ai,
                              mock_process_tags, mock_create_chat):
-        open_mock = MagicMock()
-        with patch("chatmastermind.storage.open", open_mock):
-            handle_question(self.args, self.config, True)
-            mock_process_tags.assert_called_once_with(self.args.tags,
-                                                      self.args.extags,
-                                                      [])
-            mock_create_chat.assert_called_once_with(self.question,
-                                                     self.args.tags,
-                                                     self.args.extags,
-                                                     self.config)
-            mock_pp.assert_called_once_with("test_chat")
-            mock_ai.assert_called_with("test_chat",
-                                       self.config,
-                                       self.args.number)
-            expected_calls = []
-            for num, answer in enumerate(mock_ai.return_value[0], start=1):
-                title = f'-- ANSWER {num} '
-                title_end = '-' * (terminal_width() - len(title))
-                expected_calls.append(((f'{title}{title_end}',),))
-                expected_calls.append(((answer,),))
-            expected_calls.append((("-" * terminal_width(),),))
-            expected_calls.append(((f"Usage: {mock_ai.return_value[1]}",),))
-            self.assertEqual(mock_print.call_args_list, expected_calls)
-            open_expected_calls = list([mock.call(f"{num:04d}.yaml", "w") for num in range(2, 5)])
-            open_mock.assert_has_calls(open_expected_calls, any_order=True)
+        handle_question(self.args, self.config, True)
+        mock_process_tags.assert_called_once_with(self.args.tags,
+                                                  self.args.extags,
+                                                  [])
+        mock_create_chat.assert_called_once_with(self.question,
+                                                 self.args.tags,
+                                                 self.args.extags,
+                                                 self.config,
+                                                 stats={},
+                                                 sources=None)
+        mock_display_chat.assert_called_once_with("test_chat", True, self.args.only_source_code)
+        mock_ai.assert_called_with("test_chat",
+                                   self.config,
+                                   self.args.number)
+        expected_calls = []
+        for num, answer in enumerate(mock_ai.return_value[0], start=1):
+            title = f'-- ANSWER {num} '
+            title_end = '-' * (terminal_width() - len(title))
+            expected_calls.append(((f'{title}{title_end}',),))
+            expected_calls.append(((answer,),))
+        expected_calls.append((("-" * terminal_width(),),))
+        expected_calls.append(((f"Usage: {mock_ai.return_value[1]}",),))
+        self.assertEqual(mock_print.call_args_list, expected_calls)
+        for num, answer in enumerate(mock_ai.return_value[0], start=2):
+            data = parse_answer_file(self.db / f"{num:04d}.yaml")
+            self.assertEqual(data, {'question': self.question, 'answer': answer, 'tags': self.args.tags, 'group': mock.ANY})
 
 
 class TestSaveAnswers(unittest.TestCase):
-    @mock.patch('builtins.open')
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
     @mock.patch('chatmastermind.storage.print')
-    def test_save_answers(self, print_mock, open_mock):
+    def test_save_answers(self, print_mock):
         question = "Test question?"
         answers = ["Answer 1", "Answer 2"]
         tags = ["tag1", "tag2"]
         otags = ["otag1", "otag2"]
-        config = {'db': 'test_db'}
+        config = {'db': self.tmpdir.name}
+
+        save_answers(question, answers, tags, otags, config)
+
+        with open(self.db / '.next') as f:
+            self.assertEqual(f.read(), '2')
+        self.assertEqual(parse_answer_file(self.db / '0002.yaml'),
+                         {'question': question, 'answer': 'Answer 2', 'tags': otags, 'group': mock.ANY})
+        # no temporary files are left
+        self.assertEqual(sorted(name for name in os.listdir(self.db) if name.endswith('.tmp')), [])
+
+    def test_parallel_save_answers(self):
+        code = ('import sys, contextlib, io; from chatmastermind.storage import save_answers\n'
+                'with contextlib.redirect_stdout(io.StringIO()):\n'
+                '    for num in range(10):\n'
+                '        save_answers(f"q{sys.argv[1]}-{num}", ["a1", "a2"], ["t"], None,'
+                ' {"db": sys.argv[2]}, update_index=False)\n')
+        processes = [subprocess.Popen([sys.executable, '-c', code, str(proc), self.tmpdir.name])
+                     for proc in range(4)]
+        self.assertEqual([process.wait() for process in processes], [0] * 4)
+        names = sorted(name for name in os.listdir(self.db) if name.endswith('.yaml'))
+        self.assertEqual(names, [f'{num:04d}.yaml' for num in range(1, 81)])
+        questions = [parse_answer_file(self.db / name)['question'] for name in names]
+        self.assertEqual(len(set(questions)), 40)
+
+    def test_exclusive_create(self):
+        # a lost '.next' does not overwrite existing answers
+        with open(self.db / '0001.yaml', 'w') as f:
+            yaml.dump({'question': 'old', 'answer': 'old', 'tags': []}, f)
+        with redirect_stdout(io.StringIO()):
+            save_answers('new', ['new'], [], None, {'db': self.tmpdir.name})
+        self.assertEqual(parse_answer_file(self.db / '0001.yaml')['question'], 'old')
+        self.assertEqual(parse_answer_file(self.db / '0002.yaml')['question'], 'new')
+
+    def test_lost_next_keeps_the_groups_apart(self):
+        config = {'system': 'System text', 'db': self.tmpdir.name}
+        with redirect_stdout(io.StringIO()):
+            save_answers('q1', ['a1', 'a2'], [], None, config)
+            os.unlink(self.db / '.next')
+            self.assertEqual(save_answers('q2', ['b1', 'b2'], [], None, config), 3)
+        groups = [parse_answer_file(self.db / f'{num:04d}.yaml')['group'] for num in range(1, 5)]
+        self.assertEqual(groups[0], groups[1])
+        self.assertEqual(groups[2], groups[3])
+        self.assertNotEqual(groups[0], groups[2])
+        self.assertEqual([m['content'] for m in create_chat(None, None, None, config)], ['System text', 'q1', 'a1', 'q2', 'b1'])
+
+    def test_files_are_synced_before_they_are_linked(self):
+        events = []
+        fsync, link, replace = os.fsync, os.link, os.replace
+        with patch('os.fsync', side_effect=lambda fd: events.append('fsync') or fsync(fd)), \
+                patch('os.link', side_effect=lambda src, dst: events.append(pathlib.Path(dst).name) or link(src, dst)), \
+                patch('os.replace', side_effect=lambda src, dst: events.append(pathlib.Path(dst).name) or replace(src, dst)), \
+                redirect_stdout(io.StringIO()):
+            save_answers('q', ['a1', 'a2'], [], None, {'db': self.tmpdir.name}, update_index=False)
+        self.assertEqual(events, ['fsync', '.next', 'fsync', '0001.yaml', 'fsync', '0002.yaml', 'fsync'])
 
-        with mock.patch('chatmastermind.storage.pathlib.Path.exists', return_value=True), \
-             mock.patch('chatmastermind.storage.yaml.dump'), \
-             mock.patch('io.StringIO') as stringio_mock:
-            stringio_instance = stringio_mock.return_value
-            stringio_instance.getvalue.side_effect = ["question", "answer1", "answer2"]
-            save_answers(question, answers, tags, otags, config)
+    def test_damaged_files_are_skipped(self):
+        with open(self.db / '0001.yaml', 'w') as f:
+            yaml.dump({'question': 'q1', 'answer': 'a1', 'tags': ['t']}, f)
+        with open(self.db / '0002.yaml', 'w') as f:
+            f.write('question: |\n  truncated\nanswer: "a')
+        config = {'system': 'System text', 'db': self.tmpdir.name}
+        with patch('sys.stderr', io.StringIO()) as stderr:
+            chat = create_chat('q', None, None, config)
+        self.assertEqual([m['content'] for m in chat], ['System text', 'q1', 'a1', 'q'])
+        self.assertIn('0002.yaml', stderr.getvalue())
 
-        open_calls = [
-            mock.call(pathlib.Path('test_db/.next'), 'r'),
-            mock.call(pathlib.Path('test_db/.next'), 'w'),
-        ]
-        open_mock.assert_has_calls(open_calls, any_order=True)
+
+class TestAnswerGroups(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name) / 'db'
+        self.db.mkdir()
+        # answers of an old version without groups, grouped by their question
+        for num, answer in ((1, 'old 1'), (2, 'old 2')):
+            with open(self.db / f'{num:04d}.yaml', 'w') as f:
+                yaml.dump({'question': 'old question', 'answer': answer, 'tags': ['t']}, f)
+        with open(self.db / '.next', 'w') as f:
+            f.write('2')
+        self.config = {'system': 'System text', 'db': str(self.db)}
+        with redirect_stdout(io.StringIO()):
+            save_answers('question', ['a3', 'a4', 'a5'], ['t'], None, self.config)
+            save_answers('question', ['a6', 'a7'], ['t'], None, self.config)
+        self.config_file = pathlib.Path(self.tmpdir.name) / 'config.yaml'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def history(self):
+        return [m['content'] for m in create_chat(None, ['t'], None, self.config)[1:]]
+
+    def select(self, num):
+        with open(self.config_file, 'w') as f:
+            yaml.dump(self.config, f)
+        with patch.object(sys, 'argv', ['cmm', '-c', str(self.config_file), '--select', str(num)]), \
+                redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(main(), 0)
+        return output.getvalue()
+
+    def test_one_answer_per_question(self):
+        # the same question asked twice is kept twice
+        self.assertEqual(self.history(), ['old question', 'old 1', 'question', 'a3', 'question', 'a6'])
+
+    def test_old_answers_to_the_same_question(self):
+        # only consecutive old answers to the same question were saved together
+        for num, (question, answer) in enumerate([('Write a parser', 'parser'), ('continue', 'part 2 of parser'),
+                                                  ('Write a lexer', 'lexer'), ('continue', 'part 2 of lexer')], start=8):
+            with open(self.db / f'{num:04d}.yaml', 'w') as f:
+                yaml.dump({'question': question, 'answer': answer, 'tags': ['t']}, f)
+        sqlite = str(pathlib.Path(self.tmpdir.name) / 'db.sqlite')
+        migrate(YamlBackend(self.db), open_backend({'db': sqlite}))
+        for db in (str(self.db), sqlite):
+            with self.subTest(db=db):
+                self.config['db'] = db
+                self.assertEqual(self.history()[6:], ['Write a parser', 'parser', 'continue', 'part 2 of parser',
+                                                      'Write a lexer', 'lexer', 'continue', 'part 2 of lexer'])
+
+    def test_select_answer(self):
+        for db in ('db', 'db.sqlite'):
+            if db == 'db.sqlite':
+                sqlite = str(pathlib.Path(self.tmpdir.name) / db)
+                migrate(YamlBackend(self.db), open_backend({'db': sqlite}))
+                self.config['db'] = sqlite
+            with self.subTest(db=db):
+                self.assertIn('Selected answer 4 of 3 answers', self.select(4))
+                self.select(2)
+                self.assertEqual(self.history(), ['old question', 'old 2', 'question', 'a4', 'question', 'a6'])
+                self.select(5)
+                self.assertEqual(self.history(), ['old question', 'old 2', 'question', 'a5', 'question', 'a6'])
+                backend = open_backend(self.config)
+                names = [name for name in backend.names() if backend.number(name) in (4, 5)]
+                self.assertEqual([data.get('selected') for data in backend.read(names)], [None, True])
+
+    def test_select_unknown_answer(self):
+        for num in (42, 0):
+            with patch('sys.stderr', io.StringIO()), self.assertRaises(SystemExit):
+                self.select(num)
+
+
+class TestSources(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name) / 'db'
+        self.db.mkdir()
+        self.source = pathlib.Path(self.tmpdir.name) / 'main.py'
+        self.config = {'system': 'System text', 'db': str(self.db)}
+        for question, content in (('Explain', 'v1'), ('Again', 'v1'), ('And now', 'v2')):
+            self.ask(question, content)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def ask(self, question, content, save=True):
+        with open(self.source, 'w') as f:
+            f.write(f'print("{content}")\n')
+        question, extra, blobs = compose_sources([question], [str(self.source)])
+        if save:
+            with redirect_stdout(io.StringIO()):
+                save_answers(question, ['a1', 'a2'], ['t'], None, self.config, extra=extra, blobs=blobs)
+        return question, extra
+
+    def questions(self, mode, current=None):
+        self.config['sources'] = mode
+        chat = create_chat(None, None, None, self.config, sources=current)
+        return [message['content'].split('\n\n', 1)[1] for message in chat[1::2]]
+
+    def test_sources_are_stored_once(self):
+        question, extra = self.ask('Explain', 'v1', save=False)
+        self.assertEqual(question, 'Explain\n\n```\nprint("v1")\n```')
+        data = parse_answer_file(self.db / '0001.yaml')
+        blob = extra['sources'][0]['blob']
+        self.assertEqual(data['question'], f'Explain\n\n```\n@blob:{blob}\n```')
+        self.assertEqual(data['sources'], [{'file': str(self.source), 'blob': blob}])
+        # one blob for each version of the file, only of saved answers
+        self.assertEqual(len(os.listdir(self.db / '.blobs')), 2)
+        self.ask('Unsaved', 'v3', save=False)
+        self.assertEqual(len(os.listdir(self.db / '.blobs')), 2)
+        self.assertEqual(read_blob(self.config, blob), 'print("v1")')
+
+    def test_history_sources(self):
+        v1, v2 = '```\nprint("v1")\n```', '```\nprint("v2")\n```'
+        self.assertEqual(self.questions('all'), [v1, v1, v2])
+        self.assertEqual(self.questions('dedup'), [v1, f'```\n(the content of {self.source} as above)\n```', v2])
+        older = f'```\n(an older version of {self.source}, the current one follows)\n```'
+        self.assertEqual(self.questions('latest'), [older, older, v2])
+        # the sources of the new question are not repeated in the history
+        current = self.ask('Last', 'v2', save=False)[1]['sources']
+        self.assertEqual(self.questions('dedup', current)[2], f'```\n(the content of {self.source} follows)\n```')
+
+    def test_large_blobs_are_mapped(self):
+        text = 'x' * (2 * 1024 * 1024) + 'ä'
+        with patch('mmap.mmap', wraps=__import__('mmap').mmap) as mmap_mock:
+            self.assertEqual(read_blob(self.config, store_blob(self.config, text)), text)
+        mmap_mock.assert_called_once()
 
 
 class TestAI(unittest.TestCase):
@@ -195,6 +850,540 @@ class TestAI(unittest.TestCase):
         self.assertEqual(result, expected_result)
 
 
+class TestAIStream(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {
+            "openai": {
+                "model": "gpt-4",
+                "temperature": 0.5,
+                "max_tokens": 150,
+                "top_p": 1,
+                "frequency_penalty": 0,
+                "presence_penalty": 0
+            }
+        }
+        self.chat = [{"role": "user", "content": "hello ai"}]
+
+    def test_ai_stream(self):
+        deltas = {0: [], 1: []}
+        done = []
+        with FakeOpenAIServer() as server, \
+             patch('openai.api_base', server.api_base), \
+             patch('openai.api_key', 'sk-test'):
+            answers, usage = ai_stream(self.chat, self.config, 2,
+                                       lambda index, text: deltas[index].append(text),
+                                       lambda index, answer: done.append((index, answer)))
+        self.assertEqual(answers, ['answer 1 to: hello ai', 'answer 2 to: hello ai'])
+        self.assertEqual(''.join(deltas[1]), 'answer 2 to: hello ai')
+        self.assertEqual(sorted(done), [(0, answers[0]), (1, answers[1])])
+        self.assertEqual(usage, {'prompt_tokens': 2, 'completion_tokens': 10, 'total_tokens': 12})
+        self.assertTrue(server.requests[0]['stream'])
+        self.assertEqual(server.requests[0]['n'], 2)
+
+    @patch('chatmastermind.storage.open_backend')
+    def test_answer_stream(self, open_backend_mock):
+        backend = open_backend_mock.return_value
+        backend.reserve.return_value = 5
+        write_mock = backend.write
+        output = io.StringIO()
+        with redirect_stdout(output):
+            stream = AnswerStream('question', ['tag'], None, {'db': 'db'}, 2)
+            stream.delta(0, 'first')
+            stream.delta(1, 'second')
+            stream.delta(1, ' answer')
+            stream.done(1, 'second answer')
+            write_mock.assert_called_once_with(6, {'question': 'question', 'answer': 'second answer', 'tags': ['tag'], 'group': mock.ANY})
+            self.assertNotIn('second', output.getvalue())
+            stream.delta(0, ' answer')
+            stream.done(0, 'first answer')
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('-- ANSWER 1 '))
+        self.assertEqual(lines[1], 'first answer')
+        self.assertTrue(lines[2].startswith('-- ANSWER 2 '))
+        self.assertEqual(lines[3], 'second answer')
+        write_mock.assert_called_with(5, {'question': 'question', 'answer': 'first answer', 'tags': ['tag'], 'group': mock.ANY})
+        open_backend_mock.assert_called_once_with({'db': 'db'})
+        backend.reserve.assert_called_once_with(2)
+        backend.refresh.assert_called_once()
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.batchdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name)
+        self.config = {
+            'system': 'System text',
+            'db': self.tmpdir.name,
+            'openai': {'model': 'gpt-4', 'temperature': 0.5, 'max_tokens': 150, 'top_p': 1,
+                       'frequency_penalty': 0, 'presence_penalty': 0}
+        }
+        with open(self.db / '0001.yaml', 'w') as f:
+            yaml.dump({'question': 'old question', 'answer': 'old answer', 'tags': ['t1']}, f)
+        with open(self.db / '.next', 'w') as f:
+            f.write('1')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.batchdir.cleanup()
+
+    def write_batch(self, data):
+        fname = pathlib.Path(self.batchdir.name) / 'batch.yaml'
+        with open(fname, 'w') as f:
+            yaml.dump(data, f)
+        return str(fname)
+
+    def test_read_batch(self):
+        items = read_batch(self.write_batch(['plain', {'question': 'q', 'tags': 't1', 'number': 2}]))
+        self.assertEqual(items[0]['question'], ['plain'])
+        self.assertEqual(items[1]['tags'], ['t1'])
+        self.assertEqual(items[1]['number'], 2)
+        with self.assertRaises(ValueError):
+            read_batch(self.write_batch({'question': 'q'}))
+        with self.assertRaises(ValueError):
+            read_batch(self.write_batch([{'tags': ['t1']}]))
+        with self.assertRaises(ValueError):
+            read_batch(self.write_batch([{'question': 'q', 'tag': ['t1']}]))
+
+    def test_run_batch(self):
+        items = read_batch(self.write_batch([
+            {'question': 'first', 'tags': ['t1']},
+            {'question': 'second', 'tags': ['t2'], 'number': 2},
+            {'question': 'third', 'output_tags': ['t3']},
+        ]))
+        output = io.StringIO()
+        with FakeOpenAIServer(latency=0.05) as server, \
+             patch('openai.api_base', server.api_base), \
+             patch('openai.api_key', 'sk-test'), \
+             patch('openai.requestssession', None), \
+             redirect_stdout(output), \
+             patch('chatmastermind.backend.parse_answer_files', wraps=parse_answer_files) as parse_mock:
+            result = run_batch(items, self.config, 1, concurrency=3)
+        self.assertEqual(result, 0)
+        self.assertEqual(len(server.requests), 3)
+        # the history is parsed once for the whole batch
+        parsed = [name for call in parse_mock.call_args_list for name in call.args[1]]
+        self.assertEqual(parsed, ['0001.yaml'])
+        chats = {request['messages'][-1]['content']: request['messages'] for request in server.requests}
+        self.assertEqual([m['content'] for m in chats['first']], ['System text', 'old question', 'old answer', 'first'])
+        self.assertEqual(len(chats['second']), 2)
+        saved = [parse_answer_file(self.db / f'{num:04d}.yaml') for num in range(2, 6)]
+        self.assertEqual([data['answer'] for data in saved],
+                         ['answer 1 to: first', 'answer 1 to: second', 'answer 2 to: second', 'answer 1 to: third'])
+        self.assertEqual(saved[3]['tags'], ['t3'])
+        self.assertIn('== QUESTION 3/3 ', output.getvalue())
+
+    def test_cached_usage_is_not_counted(self):
+        items = read_batch(self.write_batch(['cached', 'new']))
+        results = {'cached': (['a'], {'prompt_tokens': 5, 'completion_tokens': 2}, True),
+                   'new': (['b'], {'prompt_tokens': 7, 'completion_tokens': 3}, False)}
+        metrics.reset()
+        with patch('chatmastermind.batch.cached_ai', side_effect=lambda chat, *args: results[chat[-1]['content']]), \
+                redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(run_batch(items, self.config, 1), 0)
+        self.assertEqual(metrics.record()['counters'].get('prompt_tokens'), 7)
+        self.assertIn(" (cached)", output.getvalue())
+
+
+class TestModels(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = pathlib.Path(self.tmpdir.name) / 'db'
+        self.db.mkdir()
+        self.config = pathlib.Path(self.tmpdir.name) / 'config.yaml'
+        self.delays = {'slow': 0.3, 'fast': 0.0, 'other': 0.3}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def answers(self, request):
+        time.sleep(self.delays[request['model']])
+        return [f"{request['model']} {num}" for num in range(1, request['n'] + 1)]
+
+    def ask(self, *args):
+        with FakeOpenAIServer(answers=self.answers) as server:
+            with open(self.config, 'w') as f:
+                yaml.dump({'system': 'system', 'db': str(self.db),
+                           'openai': {'api_key': 'sk-test', 'api_base': server.api_base, 'model': 'gpt-4',
+                                      'temperature': 0.5, 'max_tokens': 10, 'top_p': 1,
+                                      'frequency_penalty': 0, 'presence_penalty': 0}}, f)
+            argv = ['cmm', '-c', str(self.config), '-q', 'question', '-n', '1', '--no-daemon', '--no-cache', *args]
+            with patch.object(sys, 'argv', argv), patch('openai.api_base'), patch('openai.api_key'), \
+                    patch('openai.requestssession', None), redirect_stdout(io.StringIO()) as output:
+                start = time.perf_counter()
+                result = main()
+                elapsed = time.perf_counter() - start
+        return result, output.getvalue(), elapsed, server.requests
+
+    def test_models(self):
+        result, output, elapsed, requests = self.ask('--models', 'slow,fast:2,other')
+        self.assertEqual(result, 0)
+        # the chat is built once and the models are asked at the same time
+        self.assertEqual(sorted((r['model'], r['n']) for r in requests), [('fast', 2), ('other', 1), ('slow', 1)])
+        self.assertEqual(len({json.dumps(r['messages']) for r in requests}), 1)
+        self.assertLess(elapsed, 0.55)
+        # the fastest model is shown first
+        self.assertLess(output.index('== MODEL fast '), output.index('== MODEL slow '))
+        saved = [parse_answer_file(self.db / name) for name in sorted(os.listdir(self.db)) if name.endswith('.yaml')]
+        self.assertEqual(sorted(data['answer'] for data in saved), ['fast 1', 'fast 2', 'other 1', 'slow 1'])
+        self.assertEqual({data['model'] for data in saved}, {'slow', 'fast', 'other'})
+        self.assertEqual({data['group'] for data in saved}, {saved[0]['group']})
+        fast = [data for data in saved if data['model'] == 'fast'][0]
+        self.assertEqual(fast['usage']['completion_tokens'], 4)
+        self.assertLess(fast['latency'], 0.3)
+
+    def test_history_fits_the_smallest_model(self):
+        for num in range(1, 11):
+            with open(self.db / f'{num:04d}.yaml', 'w') as f:
+                yaml.dump({'question': f'q{num}', 'answer': 'word ' * 1000, 'tags': ['t']}, f)
+        with open(self.db / '.next', 'w') as f:
+            f.write('10')
+        self.delays.update({'gpt-4': 0.0, 'gpt-4o': 0.0})
+        _, output, _, requests = self.ask('-M', 'gpt-4o', '--models', 'gpt-4o,gpt-4')
+        self.assertIn('Dropped', output)
+        messages = requests[0]['messages']
+        self.assertLess(sum(len(m['content']) for m in messages) // 4, 8192 - 10)
+        self.assertGreater(len(messages), 4)
+        self.assertEqual(history_config({'openai': {'model': 'gpt-4o'}}, ['gpt-4o', 'gpt-4'])['openai']['context_window'], 8192)
+        config = {'openai': {'model': 'gpt-4o'}}
+        self.assertIs(history_config(config, ['unknown']), config)
+
+    def test_invalid_models(self):
+        with patch('sys.stderr', io.StringIO()), self.assertRaises(SystemExit):
+            create_parser().parse_args(['-q', 'question', '--models', 'gpt-4:x'])
+        self.assertEqual(create_parser().parse_args(['-q', 'q', '--models', 'a, b:2']).models, [('a', None), ('b', 2)])
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config = {
+            'db': self.tmpdir.name,
+            'cache': {'max_size': 1, 'max_age': 1},
+            'openai': {'model': 'gpt-4', 'temperature': 0.5, 'max_tokens': 150, 'top_p': 1,
+                       'frequency_penalty': 0, 'presence_penalty': 0}
+        }
+        self.chat = [{'role': 'user', 'content': 'question'}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_cache_key(self):
+        key = cache_key(self.chat, self.config, 2)
+        self.assertEqual(key, cache_key(list(self.chat), self.config, 2))
+        self.assertNotEqual(key, cache_key(self.chat, self.config, 3))
+        self.assertNotEqual(key, cache_key([{'role': 'user', 'content': 'other'}], self.config, 2))
+        self.config['openai']['temperature'] = 0.7
+        self.assertNotEqual(key, cache_key(self.chat, self.config, 2))
+
+    @patch('chatmastermind.cache.ai', return_value=(['answer'], {'total_tokens': 3}))
+    def test_cached_ai(self, ai_mock):
+        self.assertEqual(cached_ai(self.chat, self.config, 1), (['answer'], {'total_tokens': 3}, False))
+        self.assertEqual(cached_ai(self.chat, self.config, 1), (['answer'], {'total_tokens': 3}, True))
+        ai_mock.assert_called_once()
+        cached_ai(self.chat, self.config, 2)
+        self.assertEqual(ai_mock.call_count, 2)
+        # without the cache it is neither read nor written
+        self.assertEqual(cached_ai(self.chat, self.config, 3, use_cache=False), (['answer'], {'total_tokens': 3}, False))
+        self.assertEqual(cached_ai(self.chat, self.config, 3), (['answer'], {'total_tokens': 3}, False))
+        self.assertEqual(ai_mock.call_count, 4)
+
+    @patch('chatmastermind.cache.ai', return_value=(['answer'], {'total_tokens': 3}))
+    def test_cache_is_opt_in(self, ai_mock):
+        del self.config['cache']
+        cached_ai(self.chat, self.config, 1)
+        cached_ai(self.chat, self.config, 1)
+        self.assertEqual(ai_mock.call_count, 2)
+        self.assertFalse((pathlib.Path(self.tmpdir.name) / '.cache').exists())
+
+    def test_evict(self):
+        directory = pathlib.Path(self.tmpdir.name)
+        now = time.time()
+        for num, age in enumerate([10, 20, 30, 100]):
+            fname = directory / f'{num}.json'
+            fname.write_text('x' * 100)
+            os.utime(fname, (now - age, now - age))
+        evict(directory, 250, 50)
+        self.assertEqual(sorted(f.name for f in directory.iterdir()), ['0.json', '1.json'])
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.config = {
+            "openai": {
+                "model": "gpt-4",
+                "temperature": 0.5,
+                "max_tokens": 10,
+                "top_p": 1,
+                "frequency_penalty": 0,
+                "presence_penalty": 0,
+                "backoff": 0.001
+            }
+        }
+        self.chat = [{"role": "user", "content": "hello ai"}]
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(60, self.clock)
+        self.assertEqual(bucket.wait_time(60), 0)
+        bucket.consume(60)
+        self.assertEqual(bucket.wait_time(6), 6)
+        self.now = 3
+        self.assertEqual(bucket.wait_time(6), 3)
+        # larger than the bucket, waits until it is full
+        self.assertEqual(bucket.wait_time(600), 57)
+
+    def test_rate_limiter_waits(self):
+        limiter = RateLimiter(rpm=60, tpm=1000, clock=self.clock, sleep=self.sleep)
+        limiter.acquire(900)
+        limiter.acquire(50)
+        self.assertEqual(self.now, 0)
+        limiter.acquire(100)
+        self.assertAlmostEqual(self.now, 3)
+        self.assertAlmostEqual(limiter.throttled, 3)
+        # the request used more tokens than estimated
+        limiter.settle(100, 160)
+        limiter.acquire(10)
+        self.assertAlmostEqual(self.now, 3 + 4.2)
+
+    def test_retry_after(self):
+        error = Exception()
+        error.headers = {'Retry-After': '2'}
+        self.assertEqual(retry_after(error), 2)
+        error.headers = {'retry-after-ms': '500', 'retry-after': '1'}
+        self.assertEqual(retry_after(error), 0.5)
+        self.assertIsNone(retry_after(Exception()))
+
+    @patch.dict('chatmastermind.scheduler._limiters', clear=True)
+    def test_ai_retries_rate_limits_and_server_errors(self):
+        with FakeOpenAIServer() as server, \
+             patch('openai.api_base', server.api_base), \
+             patch('openai.api_key', 'sk-test'), \
+             patch('openai.requestssession', None):
+            server.failures = [(429, {'Retry-After': '0.01'}), (503, {})]
+            answers, _ = ai(self.chat, self.config, 1)
+            self.assertEqual(answers, ['answer 1 to: hello ai'])
+            self.assertEqual(len(server.requests), 3)
+            self.assertEqual(throttle_stats(self.config)['retries'], 2)
+            self.assertGreaterEqual(throttle_stats(self.config)['throttled'], 0.01)
+            # later invocations of a daemon only report their own retries
+            before = throttle_stats(self.config)
+            ai(self.chat, self.config, 1)
+            self.assertEqual(throttle_stats(self.config, before), {'throttled': 0.0, 'retries': 0})
+
+            server.failures = [(400, {})]
+            with self.assertRaises(openai.error.InvalidRequestError):
+                ai(self.chat, self.config, 1)
+            self.assertEqual(len(server.requests), 5)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    @patch('chatmastermind.metrics.time.perf_counter')
+    def test_nested_phases(self, clock_mock):
+        clock_mock.side_effect = [0.0, 1.0, 3.0, 3.5]
+        with metrics.phase('outer'):
+            with metrics.phase('inner'):
+                pass
+        metrics.count('files', 2)
+        metrics.count('files')
+        clock_mock.side_effect = [10.0]
+        data = metrics.record('test')
+        self.assertEqual(data['phases'], {'inner': 2.0, 'outer': 1.5})
+        self.assertEqual(data['counters'], {'files': 3})
+        self.assertEqual(data['command'], 'test')
+
+    def test_recording_per_request(self):
+        records = []
+
+        def request():
+            with metrics.recording():
+                with metrics.phase('config'):
+                    metrics.count('files', 3)
+                records.append(metrics.record())
+        metrics.count('files')
+        thread = threading.Thread(target=request)
+        thread.start()
+        thread.join()
+        self.assertEqual(records[0]['counters'], {'files': 3})
+        self.assertIn('config', records[0]['phases'])
+        self.assertEqual(metrics.record()['counters'], {'files': 1})
+        self.assertEqual(metrics.record()['phases'], {})
+
+    def test_summary_on_current_stderr(self):
+        metrics.count('files')
+        with redirect_stderr(io.StringIO()) as err:
+            metrics.print_summary(metrics.record())
+        self.assertIn('files', err.getvalue())
+
+    def test_main_metrics_json(self):
+        with tempfile.TemporaryDirectory() as tmpdir, FakeOpenAIServer() as server:
+            db = pathlib.Path(tmpdir) / 'db'
+            db.mkdir()
+            for num, tag in enumerate(['t1', 't2', 't1'], start=1):
+                with open(db / f'{num:04d}.yaml', 'w') as f:
+                    yaml.dump({'question': f'q{num}', 'answer': f'a{num}', 'tags': [tag]}, f)
+            with open(db / '.next', 'w') as f:
+                f.write('3')
+            config = pathlib.Path(tmpdir) / 'config.yaml'
+            with open(config, 'w') as f:
+                yaml.dump({'system': 'system', 'db': str(db),
+                           'openai': {'api_key': 'sk-test', 'api_base': server.api_base, 'model': 'gpt-4',
+                                      'temperature': 0.5, 'max_tokens': 10, 'top_p': 1,
+                                      'frequency_penalty': 0, 'presence_penalty': 0}}, f)
+            metrics_file = pathlib.Path(tmpdir) / 'metrics.jsonl'
+            argv = ['cmm', '-c', str(config), '-q', 'question', '-t', 't1', '-n', '1',
+                    '--metrics-json', str(metrics_file)]
+            with patch.object(sys, 'argv', argv), \
+                 patch('openai.api_base'), patch('openai.api_key'), \
+                 redirect_stdout(io.StringIO()):
+                self.assertEqual(main(), 0)
+            with open(metrics_file) as f:
+                data = json.loads(f.readline())
+        self.assertEqual(data['command'], 'question')
+        self.assertTrue({'config', 'db_scan', 'parse', 'render', 'api', 'save'} <= data['phases'].keys())
+        self.assertEqual(data['counters']['files_scanned'], 3)
+        self.assertEqual(data['counters']['files_matched'], 2)
+        self.assertEqual(data['counters']['prompt_tokens'], 6)
+        self.assertEqual(data['counters']['completion_tokens'], 4)
+        self.assertIn('tokens_per_second', data)
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tmp = pathlib.Path(self.tmpdir.name)
+        self.runtime_dir = self.tmp / 'run'
+        self.runtime_dir.mkdir(mode=0o700)
+        self.db = self.tmp / 'db'
+        self.db.mkdir()
+        for num, tag in enumerate(['t1', 't2', 't1'], start=1):
+            with open(self.db / f'{num:04d}.yaml', 'w') as f:
+                yaml.dump({'question': f'q{num}', 'answer': f'a{num}', 'tags': [tag]}, f)
+        with open(self.db / '.next', 'w') as f:
+            f.write('3')
+        self.config = self.tmp / 'config.yaml'
+        self.env = patch.dict(os.environ, {'XDG_RUNTIME_DIR': str(self.runtime_dir)})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmpdir.cleanup()
+
+    def cmm(self, *args):
+        output = io.StringIO()
+        with patch.object(sys, 'argv', ['cmm', '-c', str(self.config), *args]), redirect_stdout(output):
+            self.assertEqual(main(), 0)
+        return output.getvalue()
+
+    def test_daemon(self):
+        with FakeOpenAIServer() as server:
+            with open(self.config, 'w') as f:
+                yaml.dump({'system': 'system', 'db': str(self.db),
+                           'openai': {'api_key': 'sk-test', 'api_base': server.api_base, 'model': 'gpt-4',
+                                      'temperature': 0.5, 'max_tokens': 10, 'top_p': 1,
+                                      'frequency_penalty': 0, 'presence_penalty': 0}}, f)
+            daemon = subprocess.Popen([sys.executable, '-m', 'chatmastermind.main', '-c', str(self.config), '--daemon'],
+                                      stdout=subprocess.PIPE, text=True)
+            try:
+                self.assertIn('Serving', daemon.stdout.readline())
+                path = socket_path(str(self.config))
+                self.assertTrue(path.exists())
+                self.assertEqual(self.cmm('-d', '-t', 't1'), self.cmm('-d', '-t', 't1', '--no-daemon'))
+                self.assertEqual(complete_remote(str(self.config), 't'), ['t1', 't2'])
+                # the profile of a request is printed by its client, with reading the config
+                with redirect_stderr(io.StringIO()) as err:
+                    self.cmm('-d', '-t', 't1', '--profile')
+                self.assertIn('config', err.getvalue())
+                output = self.cmm('-q', 'question', '-t', 't2', '-n', '1')
+                self.assertIn('answer 1 to: question', output)
+                self.assertEqual(len(server.requests), 1)
+                self.assertEqual([m['content'] for m in server.requests[0]['messages']],
+                                 ['system', 'q2', 'a2', 'question'])
+                self.assertEqual(parse_answer_file(self.db / '0004.yaml')['answer'], 'answer 1 to: question')
+            finally:
+                daemon.terminate()
+                self.assertEqual(daemon.wait(10), 0)
+                daemon.stdout.close()
+        self.assertFalse(path.exists())
+        # without a daemon the commands run in the process
+        self.assertIsNone(complete_remote(str(self.config), 't'))
+
+    def test_absolute_paths(self):
+        config = absolute_paths({'db': 'db', 'cache': {'dir': 'c', 'max_size': 10}, 'summary': {'dir': 's', 'block': 4}},
+                                '/client')
+        self.assertEqual(config['db'], '/client/db')
+        self.assertEqual(config['cache'], {'dir': '/client/c', 'max_size': 10})
+        self.assertEqual(config['summary'], {'dir': '/client/s', 'block': 4})
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fname = pathlib.Path(self.tmpdir.name) / 'config.yaml'
+        self.write({'system': 'System text', 'db': 'db', 'cache': {'max_size': 10},
+                    'openai': {'model': 'gpt-4', 'temperature': 0.8, 'max_tokens': 100,
+                               'top_p': 1, 'frequency_penalty': 0, 'presence_penalty': 0}})
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, data):
+        with open(self.fname, 'w') as f:
+            yaml.dump(data, f)
+
+    def test_loaded_once(self):
+        config = load_config(str(self.fname))
+        self.assertIs(load_config(str(self.fname)), config)
+        self.assertEqual(config['openai']['model'], 'gpt-4')
+        self.write({'db': 'other'})
+        os.utime(self.fname, ns=(time.time_ns(), time.time_ns() + 10**9))
+        self.assertEqual(dict(load_config(str(self.fname))), {'db': 'other'})
+
+    def test_immutable(self):
+        config = load_config(str(self.fname))
+        with self.assertRaises(TypeError):
+            config['db'] = 'other'  # type: ignore
+        with self.assertRaises(TypeError):
+            config['openai']['model'] = 'other'
+
+    def test_overrides(self):
+        config = load_config(str(self.fname))
+        args = argparse.Namespace(max_tokens=None, temperature=0.2, model='gpt-3.5-turbo', relevant=None)
+        overridden = apply_overrides(args, config)
+        self.assertEqual(sampling_params(overridden), ('gpt-3.5-turbo', 0.2, 100, 1, 0, 0))
+        self.assertEqual(sampling_params(config), ('gpt-4', 0.8, 100, 1, 0, 0))
+        self.assertEqual(overridden['cache'], {'max_size': 10})
+        self.assertIs(overridden.sampling_params, overridden.sampling_params)
+        self.assertEqual(db_path(with_overrides(config, {'db': 'other'})), pathlib.Path('other'))
+        # the overrides of plain dicts are layered as well
+        plain = {'db': 'db', 'cache': {'max_size': 10}}
+        self.assertEqual(with_overrides(plain, {'cache': {'dir': 'c'}})['cache'], {'dir': 'c', 'max_size': 10})
+        self.assertEqual(plain['cache'], {'max_size': 10})
+
+    def test_safe_loader(self):
+        with open(self.fname, 'w') as f:
+            f.write("db: !!python/object/apply:os.getcwd []\n")
+        with self.assertRaises(yaml.YAMLError):
+            load_config(str(self.fname))
+
+
 class TestCreateParser(unittest.TestCase):
     def test_create_parser(self):
         with patch('argparse.ArgumentParser.add_mutually_exclusive_group') as mock_add_mutually_exclusive_group:
@@ -209,3 +1398,13 @@ class TestCreateParser(unittest.TestCase):
             mock_group.add_argument.assert_any_call('-d', '--chat', help="Print chat as readable text", action='store_true')
             self.assertTrue('.config.yaml' in parser.get_default('config'))
             self.assertEqual(parser.get_default('number'), 3)
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_offline_commands_do_not_import_heavy_modules(self):
+        code = ('import sys, chatmastermind.main; '
+                'print(" ".join(m for m in ("openai", "argcomplete", "pprint") if m in sys.modules))')
+        result = subprocess.run([sys.executable, '-c', code],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '')